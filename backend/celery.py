@@ -1,4 +1,11 @@
+from typing import Any
+
 from celery import Celery
+from celery.signals import task_prerun
+
+from backend.serialization import register_serializer
+
+register_serializer()
 
 app = Celery('backend')
 
@@ -10,3 +17,10 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Load task modules from all registered Django apps.
 app.autodiscover_tasks()
+
+
+@task_prerun.connect
+def _recycle_db_connections(**_: Any) -> None:
+    # Celery's Django fixup closes inherited and obsolete connections, the ping is added on top of it
+    from backend.db import recycle_connections  # pylint: disable=import-outside-toplevel
+    recycle_connections()
@@ -0,0 +1,33 @@
+import functools
+from typing import Callable, TypeVar, Any, cast
+
+from django.conf import settings
+from django.db import connections
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+
+def recycle_connections() -> None:
+    """Prepares the current thread's database connections for a unit of work, as Django does between requests.
+
+    Connections that outlived CONN_MAX_AGE or are broken by errors are closed and reopened on the next query.
+    With DATABASE_CONN_HEALTH_CHECKS the rest is pinged as well, so that a connection dropped by the server
+    while idle fails the ping rather than the first query of the work.
+    """
+
+    for conn in connections.all():
+        if conn.connection is None or conn.in_atomic_block:
+            continue
+        conn.close_if_unusable_or_obsolete()
+        if conn.connection is not None and settings.DATABASE_CONN_HEALTH_CHECKS and not conn.is_usable():
+            conn.close()
+
+
+def with_recycled_connections(func: F) -> F:
+    """Runs recycle_connections before every call, for work done outside of requests and Celery tasks."""
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        recycle_connections()
+        return func(*args, **kwargs)
+    return cast(F, wrapper)
@@ -0,0 +1,68 @@
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, Type
+from uuid import UUID
+
+import msgpack
+from django.utils.module_loading import import_string
+from kombu.serialization import register
+
+SERIALIZER_NAME = 'msgpack-typed'
+CONTENT_TYPE = 'application/x-msgpack-typed'
+
+EXT_UUID = 1
+EXT_DATETIME = 2
+# Extension code -> enum passed to tasks. Codes are part of the message format: never reuse or renumber them
+ENUM_EXT_TYPES = {
+    16: 'video_helpers.tasks.VideoFormats',
+    17: 'telegram.tasks.TaskProgressEvent',
+}
+
+_enum_types: Dict[int, Type[Enum]] = {}
+
+
+def _get_enum_types() -> Dict[int, Type[Enum]]:
+    # Imported lazily, as task modules import Django models, which are not ready when Celery loads the serializer
+    if not _enum_types:
+        _enum_types.update({code: import_string(path) for code, path in ENUM_EXT_TYPES.items()})
+    return _enum_types
+
+
+def _default(obj: Any) -> msgpack.ExtType:
+    if isinstance(obj, UUID):
+        return msgpack.ExtType(EXT_UUID, obj.bytes)
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(EXT_DATETIME, obj.isoformat().encode())
+    if isinstance(obj, Enum):
+        for code, enum_type in _get_enum_types().items():
+            if type(obj) is enum_type:  # pylint: disable=unidiomatic-typecheck
+                return msgpack.ExtType(code, msgpack.packb(obj.value))
+    raise TypeError(f"Cannot serialize {type(obj).__name__} with {SERIALIZER_NAME}")
+
+
+def _ext_hook(code: int, data: bytes) -> Any:
+    if code == EXT_UUID:
+        return UUID(bytes=data)
+    if code == EXT_DATETIME:
+        return datetime.fromisoformat(data.decode())
+    enum_type = _get_enum_types().get(code)
+    if enum_type is not None:
+        return enum_type(msgpack.unpackb(data))
+    return msgpack.ExtType(code, data)
+
+
+def dumps(obj: Any) -> bytes:
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def loads(data: bytes) -> Any:
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False)
+
+
+def register_serializer() -> None:
+    """Registers msgpack with the types passed to tasks: UUIDs, datetimes and enums listed in ENUM_EXT_TYPES.
+
+    Tuples are decoded as lists, and VideoId is a plain string at runtime.
+    """
+
+    register(SERIALIZER_NAME, dumps, loads, content_type=CONTENT_TYPE, content_encoding='binary')
@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/wsgi/
 
 import os
 
+from django.core.signals import request_started
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_wsgi_application()
+
+from backend.db import recycle_connections  # pylint: disable=wrong-import-position
+
+request_started.connect(lambda **_: recycle_connections(), weak=False)
@@ -0,0 +1,437 @@
+"""Measures video_helpers tasks on synthetic videos and compares the results of two runs.
+
+Usage: python -m benchmarks.media run [--suite quick|full] [--case PATTERN] [--rounds N] [--output FILE]
+                                      [--baseline FILE] [--threshold FRACTION]
+       python -m benchmarks.media compare BASELINE RESULTS [--threshold FRACTION]
+
+Source videos are generated with ffmpeg once per run. Every round of a case runs in a fresh process with
+a throwaway MEDIA_ROOT and SQLite DB, and calls the task eagerly, with locking disabled, segmented encodes
+done in the task and passthrough disabled, so that encode cases measure the encoder. Rounds record wall time,
+CPU time of the process and its ffmpeg children, peak RSS of the largest of them, bytes written to storage
+and the output size. Runs compared with a baseline, and comparisons, exit with code 1 if the median
+of a metric of a case grows by more than the threshold.
+"""
+# pylint: disable=wrong-import-position
+import fnmatch
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import click
+import django
+
+django.setup()
+
+from django.conf import settings
+from django.core.management import call_command
+
+from video_helpers import tasks
+from video_helpers.ffmpeg import probe, run_ffmpeg
+from video_helpers.models import VideoFile
+from video_helpers.staging import ingest_file
+
+# Codec -> container and ffmpeg arguments encoding the synthetic source video
+SOURCE_CODECS: Dict[str, Tuple[str, List[str]]] = {
+    'h264': ('mp4', ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-c:a', 'aac']),
+    'hevc': ('mp4', ['-c:v', 'libx265', '-preset', 'ultrafast', '-tag:v', 'hvc1', '-pix_fmt', 'yuv420p',
+                     '-c:a', 'aac']),
+    'vp9': ('webm', ['-c:v', 'libvpx-vp9', '-deadline', 'realtime', '-cpu-used', '8', '-c:a', 'libopus']),
+}
+SOURCE_FPS = 30
+SOURCE_GOP_SECONDS = 2
+
+METRICS = ('wall_seconds', 'cpu_seconds', 'peak_rss_bytes', 'written_bytes', 'output_bytes')
+REGRESSION_METRICS = ('wall_seconds', 'cpu_seconds', 'peak_rss_bytes')
+
+
+@dataclass(frozen=True)
+class Source:
+    codec: str
+    width: int
+    height: int
+    duration: int
+
+    @property
+    def name(self) -> str:
+        return f"{self.codec}-{self.width}x{self.height}-{self.duration}s"
+
+    @property
+    def file_name(self) -> str:
+        return f"{self.name}.{SOURCE_CODECS[self.codec][0]}"
+
+    def generate(self, sources_dir: Path) -> Path:
+        path = sources_dir / self.file_name
+        if path.exists():
+            return path
+        tmp_path = path.with_name(f".{path.name}")
+        run_ffmpeg([
+            '-f', 'lavfi', '-i', f"testsrc2=size={self.width}x{self.height}:rate={SOURCE_FPS}:duration={self.duration}",
+            '-f', 'lavfi', '-i', f"sine=frequency=440:sample_rate=44100:duration={self.duration}",
+            *SOURCE_CODECS[self.codec][1],
+            '-g', str(SOURCE_FPS * SOURCE_GOP_SECONDS),
+            '-f', SOURCE_CODECS[self.codec][0],
+            str(tmp_path),
+        ])
+        os.replace(tmp_path, path)
+        return path
+
+
+@dataclass(frozen=True)
+class Case:
+    """A task called with the ids of its source videos, registered in the DB under ids {name}-{n}.
+
+    Download cases get the sources from a local HTTP server instead, and are called with their URLs.
+    """
+
+    name: str
+    sources: Tuple[Source, ...]
+    call: Callable[[List[str]], Any]
+    downloads: bool = False
+
+
+def _cut_middle(source: Source) -> Tuple[int, int]:
+    return source.duration * 250, source.duration * 750
+
+
+def _suite_cases(
+        codecs: Tuple[str, ...],
+        sizes: Tuple[Tuple[int, int], ...],
+        durations: Tuple[int, ...],
+        clip_counts: Tuple[int, ...],
+) -> List[Case]:
+    cases: List[Case] = []
+    sources = [
+        Source(codec, width, height, duration)
+        for codec in codecs
+        for width, height in sizes
+        for duration in durations
+    ]
+    for source in sources:
+        cut_from_ms, cut_to_ms = _cut_middle(source)
+        cases += [
+            Case(
+                name=f"download/{source.name}",
+                sources=(source,),
+                call=lambda urls: tasks.download_video_from_link.apply(args=(urls[0],)),
+                downloads=True,
+            ),
+            Case(
+                name=f"transform/{source.name}",
+                sources=(source,),
+                call=partial(_call_with_first, tasks.transform_video, cut_from_ms=cut_from_ms, cut_to_ms=cut_to_ms),
+            ),
+            Case(
+                name=f"encode/{source.name}",
+                sources=(source,),
+                call=partial(_call_with_first, tasks.encode_video, output_format=tasks.VideoFormats.MP4,
+                             bitrate_kbps=700),
+            ),
+        ]
+    # Clips are cut from the smallest source, so that clip counts are compared at the same input size
+    source = sources[0]
+    cut_from_ms, cut_to_ms = _cut_middle(source)
+    for clip_count in clip_counts:
+        cases += [
+            Case(
+                name=f"concatenate/{clip_count}x{source.name}",
+                sources=(source,) * clip_count,
+                call=lambda video_ids: tasks.concatenate_videos.apply(args=(video_ids,)),
+            ),
+            Case(
+                name=f"render/{clip_count}x{source.name}",
+                sources=(source,) * clip_count,
+                call=partial(_call_with_all, tasks.render_video, cuts=[(cut_from_ms, cut_to_ms)] * clip_count),
+            ),
+        ]
+    return cases
+
+
+def _call_with_first(task: Any, video_ids: List[str], **kwargs: Any) -> Any:
+    return task.apply(args=(video_ids[0],), kwargs=kwargs)
+
+
+def _call_with_all(task: Any, video_ids: List[str], **kwargs: Any) -> Any:
+    return task.apply(args=(video_ids,), kwargs=kwargs)
+
+
+SUITES: Dict[str, Callable[[], List[Case]]] = {
+    'quick': partial(
+        _suite_cases,
+        codecs=('h264', 'hevc', 'vp9'),
+        sizes=((640, 360), (1280, 720)),
+        durations=(10,),
+        clip_counts=(2, 4),
+    ),
+    'full': partial(
+        _suite_cases,
+        codecs=('h264', 'hevc', 'vp9'),
+        sizes=((640, 360), (1280, 720), (1920, 1080)),
+        durations=(10, 60),
+        clip_counts=(2, 4, 8),
+    ),
+}
+
+
+def _select_cases(suite: str, pattern: str) -> List[Case]:
+    return [case for case in SUITES[suite]() if fnmatch.fnmatchcase(case.name, pattern)]
+
+
+def _written_bytes() -> Optional[int]:
+    """Returns bytes the process and its finished children sent to storage, None if the OS does not count them."""
+
+    try:
+        with open('/proc/self/io', encoding='ascii') as io_file:
+            counters = dict(line.split(': ') for line in io_file.read().splitlines())
+    except OSError:
+        return None
+    return int(counters['write_bytes']) - int(counters['cancelled_write_bytes'])
+
+
+def _cpu_seconds() -> float:
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+    )
+
+
+def _peak_rss_bytes() -> int:
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # Kilobytes on Linux, bytes on macOS
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def _register_sources(case: Case, sources_dir: Path) -> List[str]:
+    video_ids: List[str] = []
+    copies_dir = Path(settings.MEDIA_ROOT) / '.sources'
+    copies_dir.mkdir(parents=True, exist_ok=True)
+    for source_n, source in enumerate(case.sources):
+        video_id = f"{source.name}-{source_n}"
+        copy_path = copies_dir / f"{video_id}.{SOURCE_CODECS[source.codec][0]}"
+        shutil.copyfile(sources_dir / source.file_name, copy_path)
+        VideoFile.from_media_info(probe(copy_path), id=video_id, file=ingest_file(copy_path)).save()
+        video_ids.append(video_id)
+    copies_dir.rmdir()
+    return video_ids
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    """Serves the sources without range requests, so downloads take the single-connection path."""
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+def _serve(sources_dir: Path) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(_QuietHandler, directory=str(sources_dir)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _run_case(case: Case, sources_dir: Path) -> Dict[str, Any]:
+    call_command('migrate', verbosity=0)
+    if case.downloads:
+        server = _serve(sources_dir)
+        args = [f"http://127.0.0.1:{server.server_address[1]}/{source.file_name}" for source in case.sources]
+    else:
+        args = _register_sources(case, sources_dir)
+
+    written_bytes_before = _written_bytes()
+    cpu_seconds_before = _cpu_seconds()
+    started_at = time.perf_counter()
+    video_id = case.call(args).get()
+    wall_seconds = time.perf_counter() - started_at
+    cpu_seconds = _cpu_seconds() - cpu_seconds_before
+    written_bytes_after = _written_bytes()
+
+    return dict(
+        wall_seconds=wall_seconds,
+        cpu_seconds=cpu_seconds,
+        peak_rss_bytes=_peak_rss_bytes(),
+        written_bytes=(
+            written_bytes_after - written_bytes_before
+            if written_bytes_before is not None and written_bytes_after is not None else None
+        ),
+        output_bytes=VideoFile.objects.get(id=video_id).size_bytes,
+    )
+
+
+def _run_round(case: Case, suite: str, sources_dir: Path) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix='video-helpers-bench-') as work_dir:
+        work_path = Path(work_dir)
+        result_path = work_path / 'result.json'
+        env = dict(
+            os.environ,
+            MEDIA_ROOT=str(work_path / 'media'),
+            DATABASE_URL=f"sqlite:///{work_path / 'db.sqlite3'}",
+            VIDEO_LOCK_REDIS_URL='',
+            VIDEO_SEGMENTED_ENCODE_DISTRIBUTED='false',
+            VIDEO_PASSTHROUGH_ENABLED='false',
+        )
+        subprocess.run(
+            [
+                sys.executable, '-m', 'benchmarks.media', 'run-case',
+                case.name, str(sources_dir), str(result_path), '--suite', suite,
+            ],
+            env=env,
+            check=True,
+        )
+        return json.loads(result_path.read_text())
+
+
+def _medians(rounds: List[Dict[str, Any]]) -> Dict[str, Any]:
+    medians: Dict[str, Any] = {}
+    for metric in METRICS:
+        values = [round_result[metric] for round_result in rounds if round_result[metric] is not None]
+        medians[metric] = statistics.median(values) if values else None
+    return medians
+
+
+def _environment() -> Dict[str, Any]:
+    ffmpeg_version = subprocess.run(
+        [settings.FFMPEG_BINARY, '-version'], capture_output=True, text=True, check=True,
+    ).stdout.splitlines()[0]
+    return dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpu_count=os.cpu_count(),
+        ffmpeg=ffmpeg_version,
+    )
+
+
+def _compare(baseline: Dict[str, Any], results: Dict[str, Any], threshold: float) -> List[str]:
+    """Prints the change of every metric of the cases in both runs, returns the regressed ones."""
+
+    regressions: List[str] = []
+    print(f"{'case':<40} {'metric':<16} {'baseline':>14} {'current':>14} {'change':>8}")
+    for case_name, case_result in results['cases'].items():
+        baseline_result = baseline['cases'].get(case_name)
+        if baseline_result is None:
+            continue
+        for metric in METRICS:
+            baseline_value = baseline_result['median'].get(metric)
+            value = case_result['median'].get(metric)
+            if not baseline_value or value is None:
+                continue
+            change = value / baseline_value - 1
+            regressed = metric in REGRESSION_METRICS and change > threshold
+            if regressed:
+                regressions.append(f"{case_name} {metric}")
+            print(
+                f"{case_name:<40} {metric:<16} {baseline_value:>14.6g} {value:>14.6g} {change:>+8.1%}"
+                f"{' REGRESSION' if regressed else ''}"
+            )
+    return regressions
+
+
+def _fail_on_regressions(regressions: List[str], threshold: float) -> None:
+    if regressions:
+        raise click.ClickException(
+            f"{len(regressions)} metrics regressed by more than {threshold:.0%}: {', '.join(regressions)}"
+        )
+
+
+@click.group()
+def main() -> None:
+    pass
+
+
+@main.command()
+@click.option('--suite', type=click.Choice(list(SUITES)), default='quick', help='Matrix of sources and cases')
+@click.option('--case', 'pattern', default='*', help='Glob of names of the cases to run, e.g. "encode/*"')
+@click.option('--rounds', default=3, help='Rounds per case, each in a fresh process, the median is compared')
+@click.option('--sources-dir', type=click.Path(file_okay=False, path_type=Path), default=None,
+              help='Directory keeping generated sources between runs, a temporary one by default')
+@click.option('--output', type=click.Path(dir_okay=False, path_type=Path), default=None, help='JSON results file')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False, path_type=Path), default=None,
+              help='JSON results of an earlier run to compare with')
+@click.option('--threshold', default=0.1, help='Fraction a metric may grow by over the baseline')
+def run(  # pylint: disable=too-many-arguments
+        *,
+        suite: str,
+        pattern: str,
+        rounds: int,
+        sources_dir: Optional[Path],
+        output: Optional[Path],
+        baseline: Optional[Path],
+        threshold: float,
+) -> None:
+    """Runs the cases and saves their results."""
+
+    cases = _select_cases(suite, pattern)
+    if not cases:
+        raise click.ClickException(f"No cases of suite {suite} match {pattern}")
+
+    with tempfile.TemporaryDirectory(prefix='video-helpers-bench-sources-') as tmp_sources_dir:
+        sources_path = sources_dir or Path(tmp_sources_dir)
+        sources_path.mkdir(parents=True, exist_ok=True)
+        for source in {source for case in cases for source in case.sources}:
+            if not (sources_path / source.file_name).exists():
+                print(f"Generating {source.name}")
+            source.generate(sources_path)
+
+        results: Dict[str, Any] = dict(
+            created_at=datetime.now(timezone.utc).isoformat(),
+            suite=suite,
+            rounds=rounds,
+            environment=_environment(),
+            cases={},
+        )
+        print(f"{'case':<40} {'wall s':>8} {'cpu s':>8} {'rss MB':>8} {'written MB':>11} {'output MB':>10}")
+        for case in cases:
+            case_rounds = [_run_round(case, suite, sources_path) for _ in range(rounds)]
+            medians = _medians(case_rounds)
+            results['cases'][case.name] = dict(rounds=case_rounds, median=medians)
+            written_mb = f"{medians['written_bytes'] / 1e6:>11.2f}" if medians['written_bytes'] is not None else 'n/a'
+            print(
+                f"{case.name:<40} {medians['wall_seconds']:>8.2f} {medians['cpu_seconds']:>8.2f}"
+                f" {medians['peak_rss_bytes'] / 1e6:>8.1f} {written_mb:>11} {medians['output_bytes'] / 1e6:>10.2f}"
+            )
+
+    if output is not None:
+        output.write_text(json.dumps(results, indent=2))
+        print(f"Results saved to {output}")
+    if baseline is not None:
+        _fail_on_regressions(_compare(json.loads(baseline.read_text()), results, threshold), threshold)
+
+
+@main.command()
+@click.argument('baseline', type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.argument('results', type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option('--threshold', default=0.1, help='Fraction a metric may grow by over the baseline')
+def compare(baseline: Path, results: Path, threshold: float) -> None:
+    """Compares saved results with a baseline, failing if any case regressed."""
+
+    regressions = _compare(json.loads(baseline.read_text()), json.loads(results.read_text()), threshold)
+    _fail_on_regressions(regressions, threshold)
+
+
+@main.command('run-case', hidden=True)
+@click.argument('case_name')
+@click.argument('sources_dir', type=click.Path(exists=True, file_okay=False, path_type=Path))
+@click.argument('result_path', type=click.Path(dir_okay=False, path_type=Path))
+@click.option('--suite', type=click.Choice(list(SUITES)), default='quick')
+def run_case(case_name: str, sources_dir: Path, result_path: Path, suite: str) -> None:
+    """Runs a round of the case in this process, which is expected to have a throwaway MEDIA_ROOT and DB."""
+
+    case, = [case for case in SUITES[suite]() if case.name == case_name]
+    result_path.write_text(json.dumps(_run_case(case, sources_dir)))
+
+
+main()
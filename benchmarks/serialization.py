@@ -0,0 +1,89 @@
+"""Compares size and encode/decode time of task messages the bot publishes, per Celery serializer.
+
+Usage: python -m benchmarks.serialization [--links N] [--rounds N]
+"""
+# pylint: disable=wrong-import-position
+import timeit
+from functools import partial
+from typing import Any, Dict, List, Tuple
+from uuid import uuid4
+
+import click
+import django
+
+django.setup()
+
+from celery.canvas import Signature
+from kombu.exceptions import EncodeError
+from kombu.serialization import dumps, loads
+
+from backend.serialization import SERIALIZER_NAME
+from telegram.pipelines import attachment_plan, links_plan
+
+SERIALIZERS = ('pickle', 'json', SERIALIZER_NAME)
+
+
+def _task_messages(plan: Signature) -> List[Tuple[Any, ...]]:
+    """Returns bodies of the messages publishing the plan, in Celery's protocol 2 format: args, kwargs, embed."""
+
+    messages: List[Tuple[Any, ...]] = []
+
+    def collect(sig: Dict[str, Any], chain_rest: List[Dict[str, Any]]) -> None:
+        if sig.get('subtask_type') == 'chain':
+            tasks = sig['kwargs']['tasks']
+            collect(tasks[0], list(reversed(tasks[1:])) + chain_rest)
+        elif sig.get('subtask_type') == 'chord':
+            for header_sig in sig['kwargs']['header']:
+                collect(header_sig, [])
+            collect(sig['kwargs']['body'], chain_rest)
+        else:
+            options = sig.get('options', {})
+            messages.append((
+                tuple(sig.get('args', ())),
+                sig.get('kwargs', {}),
+                dict(callbacks=options.get('link'), errbacks=options.get('link_error'), chain=chain_rest or None),
+            ))
+
+    collect(plan, [])
+    return messages
+
+
+def _encode_all(messages: List[Tuple[Any, ...]], serializer: str) -> None:
+    for message in messages:
+        dumps(message, serializer=serializer)
+
+
+def _decode_all(payloads: List[Tuple[str, str, bytes]]) -> None:
+    for content_type, content_encoding, payload in payloads:
+        loads(payload, content_type, content_encoding, accept=[content_type])
+
+
+@click.command()
+@click.option('--links', default=10, help='Number of links in the message')
+@click.option('--rounds', default=200, help='Encode/decode rounds per serializer')
+def main(links: int, rounds: int) -> None:
+    plans = {
+        'attachment': attachment_plan(uuid4(), 'https://example.com/video.mp4', 'AgADBAADb6cxG', 15000, 30000),
+        f"{links} links": links_plan(uuid4(), [(f"video{video_n:05d}", 15000, 30000) for video_n in range(links)]),
+    }
+
+    print(f"{'plan':<12} {'serializer':<14} {'messages':>8} {'bytes':>8} {'encode µs':>10} {'decode µs':>10}")
+    for plan_name, plan in plans.items():
+        messages = _task_messages(plan)
+        for serializer in SERIALIZERS:
+            try:
+                payloads = [dumps(message, serializer=serializer) for message in messages]
+            except EncodeError as exc:
+                print(f"{plan_name:<12} {serializer:<14} cannot serialize: {exc}")
+                continue
+            size = sum(len(payload) for _, _, payload in payloads)
+            encode_time = timeit.timeit(partial(_encode_all, messages, serializer), number=rounds)
+            decode_time = timeit.timeit(partial(_decode_all, payloads), number=rounds)
+            print(
+                f"{plan_name:<12} {serializer:<14} {len(messages):>8} {size:>8}"
+                f" {encode_time / rounds * 1e6:>10.1f} {decode_time / rounds * 1e6:>10.1f}"
+            )
+
+
+# pylint: disable=no-value-for-parameter
+main()
@@ -1,4 +1,5 @@
-# pylint: disable=wrong-import-position
+# pylint: disable=wrong-import-position,import-outside-toplevel
+import asyncio
 import logging
 
 import click
@@ -8,20 +9,29 @@ django.setup()
 
 from django.conf import settings
 
-from telegram.bot import bot
-
 
 @click.command()
 @click.option('--loglevel', help='Level for logging', default='INFO',
               type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], case_sensitive=False))
-def main(loglevel: str) -> None:
+@click.option('--mode', help='Front end mode', default=settings.TELEGRAM_BOT_MODE,
+              type=click.Choice(['threaded', 'async', 'webhook'], case_sensitive=False))
+def main(loglevel: str, mode: str) -> None:
     logger_level = getattr(logging, loglevel.upper())
     logger = logging.getLogger(__name__)
     logger.setLevel(logger_level)
 
     if settings.TELEGRAM_BOT_ENABLED:
-        logger.info(f"Starting bot {settings.TELEGRAM_BOT_TOKEN.split(':')[0]}")
-        bot.infinity_polling(logger_level=logger_level)
+        logger.info(f"Starting bot {settings.TELEGRAM_BOT_TOKEN.split(':')[0]} in {mode} mode")
+        # The front ends are imported on demand, as each of them registers its own handlers
+        if mode == 'threaded':
+            from telegram.bot import bot
+            bot.infinity_polling(logger_level=logger_level)
+        elif mode == 'async':
+            from telegram.async_bot import run_polling
+            asyncio.run(run_polling(logger_level))
+        else:
+            from telegram.async_bot import run_webhook
+            run_webhook()
     else:
         logger.warning('Telegram bot is disabled. Exiting')
 
@@ -10,3 +10,11 @@ class ChatAdmin(admin.ModelAdmin):
     sortable_by = ['id', 'username', 'last_seen_date']
     readonly_fields = ['last_seen_date']
     view_on_site = False
+
+
+@admin.register(models.TelegramFile)
+class TelegramFileAdmin(admin.ModelAdmin):
+    list_display = ['video', 'file_id', 'created_at']
+    fields = ['video', 'file_id', 'created_at']
+    readonly_fields = ['created_at']
+    view_on_site = False
@@ -0,0 +1,177 @@
+import asyncio
+import functools
+import logging
+from typing import List, Optional, Tuple, Callable, Awaitable, Set, Any, AsyncIterator
+from uuid import uuid4
+
+from aiohttp import web
+from django.conf import settings
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Message, Update
+
+from backend.db import with_recycled_connections
+from telegram.models import Chat, TaskMessage
+from telegram.pipelines import HELP_TEXT, ATTACHMENT_TASK_TOTALS, parse_video_params, attachment_plan, links_plan, \
+    links_task_totals, start_task, attachment_lane, links_lane
+from telegram.scheduler import AdmissionRejected, check_admission
+from video_helpers.utils import video_id_from_url
+
+bot = AsyncTeleBot(
+    token=settings.TELEGRAM_BOT_TOKEN,
+    parse_mode='Markdown',
+)
+logger = logging.getLogger(__name__)
+
+# Handlers beyond the limit wait for a free slot, so that bursts do not exhaust DB connections and threads
+_handler_slots = asyncio.Semaphore(settings.TELEGRAM_BOT_CONCURRENCY)
+
+
+def _bounded(handler: Callable[[Message], Awaitable[None]]) -> Callable[[Message], Awaitable[None]]:
+    @functools.wraps(handler)
+    async def wrapper(message: Message) -> None:
+        async with _handler_slots:
+            await handler(message)
+    return wrapper
+
+
+# Same handlers as telegram.bot, with DB queries and Celery publishes run in threads off the event loop
+
+@bot.message_handler(commands=['start', 'help'])
+@_bounded
+async def _cmd_start(message: Message) -> None:
+    await asyncio.to_thread(with_recycled_connections(Chat.update_from_message), message)
+    await bot.reply_to(
+        message=message,
+        text=HELP_TEXT,
+        disable_web_page_preview=True,
+    )
+
+
+@bot.message_handler(content_types=['video'])
+@_bounded
+async def _cmd_video_from_attachment(message: Message) -> None:
+    chat = await asyncio.to_thread(with_recycled_connections(Chat.update_from_message), message)
+    message_id = message.message_id
+    task_message_id = uuid4()
+
+    video_info = await bot.get_file(message.video.file_id)
+    video_url = f"https://api.telegram.org/file/bot{bot.token}/{video_info.file_path}"
+
+    params = message.caption.strip().split() if message.caption else []
+    try:
+        cut_from_ms, cut_to_ms = parse_video_params(params)
+    except ValueError as exc:
+        await bot.reply_to(message, f"❗ `{str(exc)}`")
+        return
+    try:
+        await asyncio.to_thread(with_recycled_connections(check_admission), chat, 1)
+    except AdmissionRejected as exc:
+        await bot.reply_to(message, f"❗ `{str(exc)}`")
+        return
+
+    status_message = await bot.reply_to(message, '*Starting...*', disable_notification=True)
+    task_message = TaskMessage(
+        id=task_message_id,
+        chat=chat,
+        message_id=message_id,
+        status_message_id=status_message.message_id,
+        result_message_id=None,
+        **ATTACHMENT_TASK_TOTALS,
+    )
+    await asyncio.to_thread(
+        with_recycled_connections(start_task),
+        task_message,
+        attachment_plan(
+            task_message_id,
+            video_url,
+            video_info.file_unique_id,
+            cut_from_ms,
+            cut_to_ms,
+            lane=attachment_lane(message.video.duration, cut_from_ms, cut_to_ms),
+        ),
+    )
+
+
+@bot.message_handler()
+@_bounded
+async def _cmd_video_from_links(message: Message) -> None:
+    chat = await asyncio.to_thread(with_recycled_connections(Chat.update_from_message), message)
+    message_id = message.message_id
+    task_message_id = uuid4()
+
+    videos: List[Tuple[str, Optional[int], Optional[int]]] = []
+    for video_n, line in enumerate(message.text.strip().splitlines(), start=1):
+        try:
+            video_url, *params = line.strip().split()
+            video_id = video_id_from_url(video_url)
+            cut_from_ms, cut_to_ms = parse_video_params(params)
+        except (ValueError, IndexError) as exc:
+            await bot.reply_to(message, f"❗ `Video #{video_n}: {str(exc)}`")
+            return
+        videos.append((video_id, cut_from_ms, cut_to_ms))
+    try:
+        await asyncio.to_thread(with_recycled_connections(check_admission), chat, len(videos))
+    except AdmissionRejected as exc:
+        await bot.reply_to(message, f"❗ `{str(exc)}`")
+        return
+
+    status_message = await bot.reply_to(message, '*Starting...*', disable_notification=True)
+    task_message = TaskMessage(
+        id=task_message_id,
+        chat=chat,
+        message_id=message_id,
+        status_message_id=status_message.message_id,
+        result_message_id=None,
+        **links_task_totals(len(videos)),
+    )
+    lane = await asyncio.to_thread(with_recycled_connections(links_lane), videos)
+    await asyncio.to_thread(
+        with_recycled_connections(start_task),
+        task_message,
+        links_plan(task_message_id, videos, lane),
+    )
+
+
+async def run_polling(logger_level: int) -> None:
+    await bot.remove_webhook()
+    await bot.infinity_polling(logger_level=logger_level)
+
+
+def _webhook_app() -> web.Application:
+    # Updates are acknowledged at once and handled in the background, so that Telegram does not resend them
+    # while handlers wait for a free slot
+    pending_updates: Set['asyncio.Task[Any]'] = set()
+
+    async def handle_update(request: web.Request) -> web.Response:
+        secret_token = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
+        if settings.TELEGRAM_WEBHOOK_SECRET and secret_token != settings.TELEGRAM_WEBHOOK_SECRET:
+            raise web.HTTPForbidden()
+        update = Update.de_json(await request.text())
+        task = asyncio.create_task(bot.process_new_updates([update]))
+        pending_updates.add(task)
+        task.add_done_callback(pending_updates.discard)
+        return web.Response()
+
+    async def webhook_ctx(_: web.Application) -> AsyncIterator[None]:
+        await bot.set_webhook(
+            url=settings.TELEGRAM_WEBHOOK_URL,
+            secret_token=settings.TELEGRAM_WEBHOOK_SECRET or None,
+            max_connections=settings.TELEGRAM_BOT_CONCURRENCY,
+        )
+        yield
+        if pending_updates:
+            await asyncio.wait(pending_updates)
+        await bot.close_session()
+
+    app = web.Application()
+    app.router.add_post(settings.TELEGRAM_WEBHOOK_PATH, handle_update)
+    app.cleanup_ctx.append(webhook_ctx)
+    return app
+
+
+def run_webhook() -> None:
+    web.run_app(
+        _webhook_app(),
+        host=settings.TELEGRAM_WEBHOOK_LISTEN_HOST,
+        port=settings.TELEGRAM_WEBHOOK_LISTEN_PORT,
+    )
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.5 on 2026-10-16 23:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_helpers', '0004_videofile_source_offset_ms'),
+        ('telegram', '0002_taskmessage_encode_tasks_done_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelegramFile',
+            fields=[
+                ('video', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='video_helpers.videofile')),
+                ('file_id', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
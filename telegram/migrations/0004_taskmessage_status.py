@@ -0,0 +1,28 @@
+# Generated by Django 4.0.5 on 2026-10-17 00:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram', '0003_telegramfile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskmessage',
+            name='status_flush_pending',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='taskmessage',
+            name='status_flushed_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='taskmessage',
+            name='status_text',
+            field=models.TextField(default=''),
+        ),
+    ]
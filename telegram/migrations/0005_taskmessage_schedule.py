@@ -0,0 +1,41 @@
+# Generated by Django 4.0.5 on 2026-10-17 00:40
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_existing_finished(apps, schema_editor):
+    # Messages created before scheduling were started right away, they must not be scheduled again
+    _ = schema_editor
+    TaskMessage = apps.get_model('telegram', 'TaskMessage')
+    TaskMessage.objects.update(started_at=F('created_at'), finished_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram', '0004_taskmessage_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskmessage',
+            name='finished_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='taskmessage',
+            name='plan',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='taskmessage',
+            name='started_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(mark_existing_finished, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='taskmessage',
+            index=models.Index(condition=models.Q(('finished_at__isnull', True)), fields=['created_at'], name='taskmessage_unfinished_idx'),
+        ),
+    ]
@@ -1,8 +1,20 @@
 from __future__ import annotations
 
-from django.db import models
+import threading
+import time
+from typing import Dict, Tuple, Optional
+
+from django.conf import settings
+from django.db import models, connection
+from django.utils import timezone
 from telebot.types import Message
 
+from video_helpers.models import VideoFile
+
+# Chat id -> when it was upserted last and its upserted fields
+_recent_chats: Dict[int, Tuple[float, Tuple[Optional[str], Optional[str], Optional[str]]]] = {}
+_recent_chats_lock = threading.Lock()
+
 
 class Chat(models.Model):
     id = models.BigIntegerField(primary_key=True)
@@ -13,11 +25,44 @@ class Chat(models.Model):
 
     @classmethod
     def update_from_message(cls, message: Message) -> Chat:
-        chat, _ = cls.objects.get_or_create(id=message.chat.id)
-        chat.username = message.chat.username or None
-        chat.first_name = message.chat.first_name or None
-        chat.last_name = message.chat.last_name or None
-        chat.save()
+        """Upserts the chat in a single query, skipping it if the chat was upserted within TELEGRAM_CHAT_CACHE_TTL."""
+
+        chat_fields = (
+            message.chat.username or None,
+            message.chat.first_name or None,
+            message.chat.last_name or None,
+        )
+        now = timezone.now()
+        chat = cls.from_db(
+            connection.alias,
+            ['id', 'username', 'first_name', 'last_name', 'last_seen_date'],
+            [message.chat.id, *chat_fields, now],
+        )
+
+        with _recent_chats_lock:
+            recent_chat = _recent_chats.get(chat.id)
+        if recent_chat is not None:
+            upserted_at, upserted_fields = recent_chat
+            if upserted_fields == chat_fields and time.monotonic() - upserted_at < settings.TELEGRAM_CHAT_CACHE_TTL:
+                return chat
+
+        quote_name = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {quote_name(cls._meta.db_table)}"
+                f" (id, username, first_name, last_name, last_seen_date) VALUES (%s, %s, %s, %s, %s)"
+                f" ON CONFLICT (id) DO UPDATE SET"
+                f" username = EXCLUDED.username,"
+                f" first_name = EXCLUDED.first_name,"
+                f" last_name = EXCLUDED.last_name,"
+                f" last_seen_date = EXCLUDED.last_seen_date",
+                [chat.id, *chat_fields, now],
+            )
+
+        with _recent_chats_lock:
+            if len(_recent_chats) >= settings.TELEGRAM_CHAT_CACHE_SIZE:
+                _recent_chats.clear()
+            _recent_chats[chat.id] = (time.monotonic(), chat_fields)
         return chat
 
     def __str__(self) -> str:
@@ -40,4 +85,34 @@ class TaskMessage(models.Model):
     encode_tasks_total = models.IntegerField(default=0)
     encode_tasks_done = models.IntegerField(default=0)
 
+    # Progress is flushed to the status message at most once per TELEGRAM_PROGRESS_INTERVAL
+    status_text = models.TextField(default='')
+    status_flush_pending = models.BooleanField(default=False)
+    status_flushed_at = models.DateTimeField(null=True)
+
+    # Celery signature of the work, started by the scheduler when the chat's turn comes
+    plan = models.BinaryField(null=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(finished_at__isnull=True),
+                name='taskmessage_unfinished_idx',
+            ),
+        ]
+
+
+class TelegramFile(models.Model):
+    """Telegram's id of an uploaded video, which is sent again without uploading it.
+
+    Deleted along with the video when it is evicted from the cache.
+    """
+
+    video = models.OneToOneField(VideoFile, primary_key=True, on_delete=models.CASCADE)
+    file_id = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
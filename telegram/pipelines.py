@@ -0,0 +1,314 @@
+import logging
+from enum import Enum
+from typing import List, Optional, Tuple, Dict
+from uuid import UUID
+
+import pytimeparse
+from celery.canvas import Signature, chain, chord
+from django.conf import settings
+
+from telegram.models import TaskMessage
+from telegram import scheduler
+from telegram.tasks import reply_with_video, reply_with_error_msg, update_task_progress, TaskProgressEvent, \
+    dispatch_task_messages
+from video_helpers.tasks import download_video_from_youtube, transform_video, concatenate_videos, \
+    download_video_from_link, encode_video, render_video
+from video_helpers.models import VideoFile
+from video_helpers.utils import hashed
+
+logger = logging.getLogger(__name__)
+
+HELP_TEXT = '\n'.join((
+    'Send me a few links to Youtube videos in a single message to combine them into one video.',
+    '',
+    '*Combine multiple videos*:`',
+    'https://www.youtube.com/shorts/k2YGTSCT0q0 from 00:15.250 to 00:30',
+    'https://www.youtube.com/watch?v=CRTjZTwIyI0 to 00:42',
+    'https://www.youtube.com/shorts/_Ptnlp9QKgw',
+    '`',
+    '*Cut a fragment from a video*:`',
+    'https://www.youtube.com/shorts/_Ptnlp9QKgw from 00:15 to 00:20'
+    '`',
+))
+
+
+def parse_video_params(params: List[str]) -> Tuple[Optional[int], Optional[int]]:
+    params = [el.casefold() for el in params]
+    if 'from' in params:
+        try:
+            cut_from_time = pytimeparse.parse(params[params.index('from')+1])
+        except IndexError:
+            cut_from_time = None
+        if cut_from_time is None:
+            raise ValueError('Cannot parse value for the "from" parameter')
+        cut_from_ms = int(cut_from_time * 1000)
+    else:
+        cut_from_ms = None
+
+    if 'to' in params:
+        try:
+            cut_to_time = pytimeparse.parse(params[params.index('to')+1])
+        except IndexError:
+            cut_to_time = None
+        if cut_to_time is None:
+            raise ValueError('Cannot parse value for the "to" parameter')
+        cut_to_ms = int(cut_to_time * 1000)
+    else:
+        cut_to_ms = None
+
+    return cut_from_ms, cut_to_ms
+
+
+class Lane(Enum):
+    """Size tier of jobs: short jobs get workers of their own, so that they do not wait behind long encodes."""
+
+    FAST = 'fast'
+    BULK = 'bulk'
+
+    @property
+    def download_queue(self) -> str:
+        return f"video_download_{self.value}"
+
+    @property
+    def processing_queue(self) -> str:
+        return f"video_processing_{self.value}"
+
+
+def _clip_seconds(duration: Optional[float], cut_from_ms: Optional[int], cut_to_ms: Optional[int]) -> float:
+    if duration is None:
+        duration = settings.VIDEO_COST_UNKNOWN_DURATION
+    end = min(cut_to_ms / 1000, duration) if cut_to_ms is not None else duration
+    return max(end - (cut_from_ms or 0) / 1000, 0.0)
+
+
+def _job_cost(clips_seconds: List[float], *, staged: bool) -> float:
+    """Estimates the work of a job in seconds of video encoded, plus a fixed overhead per clip.
+
+    Staged jobs encode the cut clips and then their concatenation, fused renders encode once.
+    """
+
+    encode_passes = 2 if staged else 1
+    cost = sum(clips_seconds) * encode_passes + len(clips_seconds) * settings.VIDEO_COST_CLIP_OVERHEAD
+    if settings.TELEGRAM_VIDEO_MAX_BYTES:
+        cost += settings.VIDEO_TARGET_SIZE_SAMPLES * settings.VIDEO_TARGET_SIZE_SAMPLE_SECONDS
+    return cost
+
+
+def _lane(cost: float) -> Lane:
+    lane = Lane.FAST if cost <= settings.VIDEO_FAST_LANE_MAX_COST else Lane.BULK
+    logger.info(f"Job cost is estimated at {cost:.0f}s of video, routing it to the {lane.value} lane")
+    return lane
+
+
+def attachment_lane(duration: Optional[float], cut_from_ms: Optional[int], cut_to_ms: Optional[int]) -> Lane:
+    return _lane(_job_cost([_clip_seconds(duration, cut_from_ms, cut_to_ms)], staged=True))
+
+
+def links_lane(videos: List[Tuple[str, Optional[int], Optional[int]]]) -> Lane:
+    """Picks the lane for a links job, looking up durations of the videos already downloaded in full."""
+
+    durations: Dict[str, float] = dict(
+        VideoFile.objects
+        .filter(id__in=[hashed(video_id)[:32] for video_id, _, _ in videos])
+        .values_list('id', 'duration')
+    )
+    clips_seconds = [
+        _clip_seconds(durations.get(hashed(video_id)[:32]), cut_from_ms, cut_to_ms)
+        for video_id, cut_from_ms, cut_to_ms in videos
+    ]
+    return _lane(_job_cost(clips_seconds, staged=not settings.VIDEO_FUSED_RENDER_ENABLED))
+
+
+def attachment_plan(  # pylint: disable=too-many-arguments
+        task_message_id: UUID,
+        video_url: str,
+        video_id: str,
+        cut_from_ms: Optional[int],
+        cut_to_ms: Optional[int],
+        *,
+        lane: Lane = Lane.BULK,
+) -> Signature:
+    return chain(
+        download_video_from_link.signature(
+            kwargs=dict(
+                url=video_url,
+                video_id=video_id,
+            ),
+            link=update_task_progress.si(
+                event=TaskProgressEvent.DOWNLOAD_TASK_FINISHED,
+                task_message_pk=task_message_id,
+            ),
+            queue=lane.download_queue,
+        ),
+        transform_video.signature(
+            kwargs=dict(
+                cut_from_ms=cut_from_ms,
+                cut_to_ms=cut_to_ms,
+            ),
+            link=update_task_progress.si(
+                event=TaskProgressEvent.TRANSFORM_TASK_FINISHED,
+                task_message_pk=task_message_id,
+            ),
+            queue=lane.processing_queue,
+        ),
+        encode_video.signature(
+            kwargs=dict(
+                target_size_bytes=settings.TELEGRAM_VIDEO_MAX_BYTES or None,
+            ),
+            link=update_task_progress.si(
+                event=TaskProgressEvent.ENCODE_TASK_FINISHED,
+                task_message_pk=task_message_id,
+            ),
+            queue=lane.processing_queue,
+        ),
+        reply_with_video.signature(
+            kwargs=dict(
+                task_message_pk=task_message_id,
+            ),
+        ),
+    )
+
+
+ATTACHMENT_TASK_TOTALS = dict(
+    download_tasks_total=1,
+    transform_tasks_total=1,
+    concatenate_tasks_total=0,
+    encode_tasks_total=1,
+)
+
+
+def _download_from_youtube_task(
+        task_message_id: UUID,
+        video_id: str,
+        cut_from_ms: Optional[int],
+        cut_to_ms: Optional[int],
+        lane: Lane,
+) -> Signature:
+    return download_video_from_youtube.signature(
+        kwargs=dict(
+            youtube_video_id=video_id,
+            cut_from_ms=cut_from_ms,
+            cut_to_ms=cut_to_ms,
+        ),
+        link=update_task_progress.si(
+            event=TaskProgressEvent.DOWNLOAD_TASK_FINISHED,
+            task_message_pk=task_message_id,
+        ),
+        queue=lane.download_queue,
+    )
+
+
+def _staged_plan(
+        task_message_id: UUID,
+        videos: List[Tuple[str, Optional[int], Optional[int]]],
+        lane: Lane,
+) -> Signature:
+    """Downloads and cuts every video, then concatenates and encodes them, caching every intermediate result."""
+
+    prepare_video_tasks: List[Signature] = []
+    for video_id, cut_from_ms, cut_to_ms in videos:
+        prepare_video_tasks.append(
+            chain(
+                _download_from_youtube_task(task_message_id, video_id, cut_from_ms, cut_to_ms, lane),
+                transform_video.signature(
+                    kwargs=dict(
+                        cut_from_ms=cut_from_ms,
+                        cut_to_ms=cut_to_ms,
+                    ),
+                    link=update_task_progress.si(
+                        event=TaskProgressEvent.TRANSFORM_TASK_FINISHED,
+                        task_message_pk=task_message_id,
+                    ),
+                    queue=lane.processing_queue,
+                ),
+            ),
+        )
+
+    return chord(
+        header=prepare_video_tasks,
+        body=chain(
+            concatenate_videos.signature(
+                link=update_task_progress.si(
+                    event=TaskProgressEvent.CONCATENATE_TASK_FINISHED,
+                    task_message_pk=task_message_id,
+                ),
+                queue=lane.processing_queue,
+            ),
+            encode_video.signature(
+                kwargs=dict(
+                    target_size_bytes=settings.TELEGRAM_VIDEO_MAX_BYTES or None,
+                ),
+                link=update_task_progress.si(
+                    event=TaskProgressEvent.ENCODE_TASK_FINISHED,
+                    task_message_pk=task_message_id,
+                ),
+                queue=lane.processing_queue,
+            ),
+            reply_with_video.signature(
+                kwargs=dict(
+                    task_message_pk=task_message_id,
+                ),
+            )
+        ),
+    )
+
+
+def _render_plan(
+        task_message_id: UUID,
+        videos: List[Tuple[str, Optional[int], Optional[int]]],
+        lane: Lane,
+) -> Signature:
+    """Downloads every video, then cuts, concatenates and encodes them in a single pass."""
+
+    return chord(
+        header=[
+            _download_from_youtube_task(task_message_id, video_id, cut_from_ms, cut_to_ms, lane)
+            for video_id, cut_from_ms, cut_to_ms in videos
+        ],
+        body=chain(
+            render_video.signature(
+                kwargs=dict(
+                    cuts=[(cut_from_ms, cut_to_ms) for _, cut_from_ms, cut_to_ms in videos],
+                    target_size_bytes=settings.TELEGRAM_VIDEO_MAX_BYTES or None,
+                ),
+                link=update_task_progress.si(
+                    event=TaskProgressEvent.ENCODE_TASK_FINISHED,
+                    task_message_pk=task_message_id,
+                ),
+                queue=lane.processing_queue,
+            ),
+            reply_with_video.signature(
+                kwargs=dict(
+                    task_message_pk=task_message_id,
+                ),
+            )
+        ),
+    )
+
+
+def links_plan(
+        task_message_id: UUID,
+        videos: List[Tuple[str, Optional[int], Optional[int]]],
+        lane: Lane = Lane.BULK,
+) -> Signature:
+    if settings.VIDEO_FUSED_RENDER_ENABLED:
+        return _render_plan(task_message_id, videos, lane)
+    return _staged_plan(task_message_id, videos, lane)
+
+
+def links_task_totals(videos_count: int) -> Dict[str, int]:
+    return dict(
+        download_tasks_total=videos_count,
+        transform_tasks_total=0 if settings.VIDEO_FUSED_RENDER_ENABLED else videos_count,
+        concatenate_tasks_total=0 if settings.VIDEO_FUSED_RENDER_ENABLED else 1,
+        encode_tasks_total=1,
+    )
+
+
+def start_task(task_message: TaskMessage, plan: Signature) -> None:
+    """Queues the plan, which is started by the scheduler when the chat's turn comes."""
+
+    plan.link_error(reply_with_error_msg.s(task_message.id))
+    scheduler.enqueue(task_message, plan)
+    update_task_progress.delay(None, task_message.id)
+    dispatch_task_messages.delay()
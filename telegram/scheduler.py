@@ -0,0 +1,138 @@
+import logging
+from collections import Counter, deque
+from datetime import datetime
+from typing import Deque, Dict, List
+from uuid import UUID
+
+from celery.canvas import Signature, signature
+from django.conf import settings
+from django.db.models import Count, Max, Q, Sum
+from django.utils import timezone
+
+from backend.serialization import dumps, loads
+from telegram.models import Chat, TaskMessage
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """The chat is over its quotas, the message is shown to the user."""
+
+
+def check_admission(chat: Chat, videos_count: int) -> None:
+    """Raises AdmissionRejected if a message with the videos would put the chat over its quotas.
+
+    Quotas are checked without locking, so concurrent messages of a chat may exceed them by a message.
+    Messages that never finish, e.g. after their task messages were lost, stop counting after TELEGRAM_TASK_TIMEOUT.
+    """
+
+    # A message must fit into the running capacity, or dispatch() could only start it when nothing else runs
+    max_message_videos = min(settings.TELEGRAM_CHAT_MAX_QUEUED_VIDEOS, settings.TELEGRAM_MAX_RUNNING_VIDEOS)
+    if videos_count > max_message_videos:
+        raise AdmissionRejected(f"Too many videos in one message: {videos_count}, the limit is {max_message_videos}")
+    # Messages started longer than TELEGRAM_TASK_TIMEOUT ago are taken for lost, as dispatch() does
+    running_since = timezone.now() - settings.TELEGRAM_TASK_TIMEOUT
+    unfinished = TaskMessage.objects.filter(
+        Q(started_at__isnull=True) | Q(started_at__gte=running_since),
+        chat=chat,
+        finished_at__isnull=True,
+    ).aggregate(
+        tasks_count=Count('id'),
+        videos_count=Sum('download_tasks_total'),
+    )
+    if unfinished['tasks_count'] >= settings.TELEGRAM_CHAT_MAX_QUEUED_TASKS:
+        raise AdmissionRejected(
+            f"You have {unfinished['tasks_count']} messages in progress, send this one after they are done"
+        )
+    if (unfinished['videos_count'] or 0) + videos_count > settings.TELEGRAM_CHAT_MAX_QUEUED_VIDEOS:
+        raise AdmissionRejected(
+            f"You have {unfinished['videos_count']} videos in progress, send this message after they are done"
+        )
+
+
+def enqueue(task_message: TaskMessage, plan: Signature) -> None:
+    task_message.plan = dumps(plan)
+    task_message.started_at = None
+    task_message.finished_at = None
+    task_message.save()
+
+
+def finish(task_message_pk: UUID) -> None:
+    TaskMessage.objects.filter(pk=task_message_pk, finished_at__isnull=True).update(finished_at=timezone.now())
+
+
+def _start(task_message: TaskMessage) -> bool:
+    if not TaskMessage.objects.filter(pk=task_message.pk, started_at__isnull=True).update(started_at=timezone.now()):
+        return False
+    try:
+        signature(loads(bytes(task_message.plan or b''))).apply_async()
+    except Exception:
+        TaskMessage.objects.filter(pk=task_message.pk).update(started_at=None)
+        raise
+    return True
+
+
+def dispatch() -> List[UUID]:
+    """Starts queued task messages while there is capacity, chats taking turns. Returns ids of the started ones.
+
+    The chat that started its last message the longest time ago goes first, so a chat with many messages
+    does not delay chats with a few. A chat with running videos is kept within its fair share of
+    TELEGRAM_MAX_RUNNING_VIDEOS; a chat whose next message does not fit waits, while the chats after it go on.
+    Must not run concurrently with itself.
+    """
+
+    running_since = timezone.now() - settings.TELEGRAM_TASK_TIMEOUT
+    running = TaskMessage.objects.filter(started_at__gte=running_since, finished_at__isnull=True).values_list(
+        'chat_id', 'download_tasks_total',
+    )
+    running_per_chat: Counter = Counter()
+    running_videos_per_chat: Counter = Counter()
+    for chat_id, videos_count in running:
+        running_per_chat[chat_id] += 1
+        running_videos_per_chat[chat_id] += max(videos_count, 1)
+    running_videos = sum(running_videos_per_chat.values())
+
+    queues: Dict[int, Deque[TaskMessage]] = {}
+    queued = TaskMessage.objects.filter(started_at__isnull=True, finished_at__isnull=True).order_by('created_at')
+    for task_message in queued:
+        queues.setdefault(task_message.chat_id, deque()).append(task_message)
+    if not queues:
+        return []
+    chat_share = max(1, settings.TELEGRAM_MAX_RUNNING_VIDEOS // len(set(running_per_chat) | set(queues)))
+
+    last_started_at: Dict[int, datetime] = dict(
+        TaskMessage.objects
+        .filter(chat_id__in=queues, started_at__isnull=False)
+        .values('chat_id')
+        .annotate(last_started_at=Max('started_at'))
+        .values_list('chat_id', 'last_started_at')
+    )
+    # Chats that never started a message go first
+    chat_ids = sorted(queues, key=lambda chat_id: (chat_id in last_started_at, last_started_at.get(chat_id)))
+
+    started: List[UUID] = []
+    while chat_ids:
+        for chat_id in list(chat_ids):
+            if running_per_chat[chat_id] >= settings.TELEGRAM_CHAT_MAX_RUNNING_TASKS:
+                chat_ids.remove(chat_id)
+                continue
+            task_message = queues[chat_id][0]
+            videos_count = max(task_message.download_tasks_total, 1)
+            # Nothing running lets a message start even if it is larger than the share or the capacity
+            if running_videos_per_chat[chat_id] and running_videos_per_chat[chat_id] + videos_count > chat_share:
+                chat_ids.remove(chat_id)
+                continue
+            if running_videos and running_videos + videos_count > settings.TELEGRAM_MAX_RUNNING_VIDEOS:
+                chat_ids.remove(chat_id)
+                continue
+            queues[chat_id].popleft()
+            if not queues[chat_id]:
+                chat_ids.remove(chat_id)
+            if not _start(task_message):
+                continue
+            logger.info(f"Started task message {task_message.pk} of chat {chat_id}")
+            running_videos += videos_count
+            running_per_chat[chat_id] += 1
+            running_videos_per_chat[chat_id] += videos_count
+            started.append(task_message.pk)
+    return started
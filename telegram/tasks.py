@@ -1,14 +1,20 @@
+import logging
 from enum import Enum
+from functools import partial
 from typing import Optional, NewType, List
 from uuid import UUID
 
 import telebot
-from celery import shared_task
+from celery import shared_task, Task
 from django.conf import settings
 from django.db.models import F
+from django.utils import timezone
 from telebot.apihelper import ApiTelegramException
+from telebot.types import Message
 
-from telegram.models import TaskMessage
+from telegram import scheduler
+from telegram.models import TaskMessage, TelegramFile
+from video_helpers.locks import InFlight, single_flight
 from video_helpers.models import VideoFile
 
 bot = telebot.TeleBot(
@@ -16,27 +22,59 @@ bot = telebot.TeleBot(
     parse_mode='Markdown',
     threaded=False,
 )
+logger = logging.getLogger(__name__)
 
 
 VideoId = NewType('VideoId', str)
 
+# Parts of Bot API error descriptions telling that a file id is unknown or expired, e.g.
+# "Bad Request: wrong file identifier/HTTP URL specified", so the file has to be uploaded again
+STALE_FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file identifier', 'file_reference_expired')
+
+
+def _is_stale_file_id_error(exc: ApiTelegramException) -> bool:
+    description = (exc.description or '').lower()
+    return exc.error_code == 400 and any(error in description for error in STALE_FILE_ID_ERRORS)
+
+
+def _send_video(task_message: TaskMessage, video: VideoFile) -> Message:
+    send_video = partial(
+        bot.send_video,
+        chat_id=task_message.chat.id,
+        reply_to_message_id=task_message.message_id,
+        supports_streaming=True,
+        duration=round(video.duration),
+        width=video.width,
+        height=video.height,
+    )
+
+    telegram_file = TelegramFile.objects.filter(video=video).first()
+    if telegram_file is not None:
+        try:
+            return send_video(video=telegram_file.file_id)
+        except ApiTelegramException as exc:
+            if not _is_stale_file_id_error(exc):
+                raise
+            logger.warning(f"Telegram rejected file id of video {video.id}, uploading it again: {exc.description}")
+            telegram_file.delete()
+
+    with video.file.open(mode='rb') as file:
+        result_message = send_video(video=file)
+    uploaded_file = result_message.video or result_message.animation or result_message.document
+    if uploaded_file is not None:
+        TelegramFile.objects.update_or_create(video=video, defaults=dict(file_id=uploaded_file.file_id))
+    return result_message
+
 
 @shared_task(acks_late=True, ignore_result=True)
 def reply_with_video(video_id: VideoId, task_message_pk: UUID) -> None:
     task_message: TaskMessage = TaskMessage.objects.select_related().get(pk=task_message_pk)
     video: VideoFile = VideoFile.objects.get(id=video_id)
-    with video.file.open(mode='rb') as file:
-        result_message = bot.send_video(
-            chat_id=task_message.chat.id,
-            reply_to_message_id=task_message.message_id,
-            video=file,
-            supports_streaming=True,
-            duration=video.duration,
-            width=video.width,
-            height=video.height,
-        )
+    result_message = _send_video(task_message, video)
     task_message.result_message_id = result_message.message_id
     task_message.save(update_fields=('result_message_id',))
+    scheduler.finish(task_message.pk)
+    dispatch_task_messages.delay()
     try:
         bot.delete_message(chat_id=task_message.chat.id, message_id=task_message.status_message_id)
     except ApiTelegramException as exc:
@@ -56,6 +94,8 @@ def reply_with_error_msg(request, exc, traceback, task_message_pk: UUID) -> None
     )
     task_message.result_message_id = result_message.message_id
     task_message.save(update_fields=('result_message_id',))
+    scheduler.finish(task_message.pk)
+    dispatch_task_messages.delay()
     try:
         bot.delete_message(chat_id=task_message.chat.id, message_id=task_message.status_message_id)
     except ApiTelegramException as error:
@@ -70,23 +110,38 @@ class TaskProgressEvent(Enum):
     ENCODE_TASK_FINISHED = 4
 
 
+PROGRESS_COUNTER_FIELDS = {
+    TaskProgressEvent.DOWNLOAD_TASK_FINISHED: 'download_tasks_done',
+    TaskProgressEvent.TRANSFORM_TASK_FINISHED: 'transform_tasks_done',
+    TaskProgressEvent.CONCATENATE_TASK_FINISHED: 'concatenate_tasks_done',
+    TaskProgressEvent.ENCODE_TASK_FINISHED: 'encode_tasks_done',
+}
+
+
 @shared_task(acks_late=True, ignore_result=True)
 def update_task_progress(event: Optional[TaskProgressEvent], task_message_pk: UUID) -> None:
-    task_message: TaskMessage = TaskMessage.objects.select_related().get(pk=task_message_pk)
-    if event is TaskProgressEvent.DOWNLOAD_TASK_FINISHED:
-        TaskMessage.objects.filter(pk=task_message.pk).update(download_tasks_done=F('download_tasks_done') + 1)
-    elif event is TaskProgressEvent.TRANSFORM_TASK_FINISHED:
-        TaskMessage.objects.filter(pk=task_message.pk).update(transform_tasks_done=F('transform_tasks_done') + 1)
-    elif event is TaskProgressEvent.CONCATENATE_TASK_FINISHED:
-        TaskMessage.objects.filter(pk=task_message.pk).update(concatenate_tasks_done=F('concatenate_tasks_done') + 1)
-    elif event is TaskProgressEvent.ENCODE_TASK_FINISHED:
-        TaskMessage.objects.filter(pk=task_message.pk).update(encode_tasks_done=F('encode_tasks_done') + 1)
-    elif event is None:
-        pass
-    else:
-        raise ValueError(f"Unknown event: TaskProgressEvent = {event}")
-
-    task_message.refresh_from_db()
+    """Counts the event and schedules a flush of the status message, unless one is already scheduled."""
+
+    if event is not None:
+        try:
+            counter_field = PROGRESS_COUNTER_FIELDS[event]
+        except KeyError as exc:
+            raise ValueError(f"Unknown event: TaskProgressEvent = {event}") from exc
+        TaskMessage.objects.filter(pk=task_message_pk).update(**{counter_field: F(counter_field) + 1})
+
+    if not TaskMessage.objects.filter(pk=task_message_pk, status_flush_pending=False).update(status_flush_pending=True):
+        return
+    status_flushed_at = TaskMessage.objects.values_list('status_flushed_at', flat=True).get(pk=task_message_pk)
+    countdown = 0.0
+    if status_flushed_at is not None:
+        next_flush_at = status_flushed_at + settings.TELEGRAM_PROGRESS_INTERVAL
+        countdown = max((next_flush_at - timezone.now()).total_seconds(), 0.0)
+    flush_task_progress.apply_async(args=(task_message_pk,), countdown=countdown)
+
+
+def _render_progress(task_message: TaskMessage) -> str:
+    if task_message.started_at is None:
+        return "*Waiting for other videos to be processed...*"
     msg_lines: List[str] = [
         "*Processing videos*",
         "",
@@ -107,7 +162,20 @@ def update_task_progress(event: Optional[TaskProgressEvent], task_message_pk: UU
         msg_lines.append(
             f"Encoded: {task_message.encode_tasks_done}/{task_message.encode_tasks_total}"
         )
-    msg_text = '\n'.join(msg_lines)
+    return '\n'.join(msg_lines)
+
+
+@shared_task(acks_late=True, ignore_result=True, bind=True, max_retries=5)
+def flush_task_progress(self: Task, task_message_pk: UUID) -> None:
+    # Events counted from now on schedule the next flush
+    TaskMessage.objects.filter(pk=task_message_pk).update(status_flush_pending=False)
+    task_message: TaskMessage = TaskMessage.objects.select_related().get(pk=task_message_pk)
+    if task_message.result_message_id is not None:
+        return
+
+    msg_text = _render_progress(task_message)
+    if msg_text == task_message.status_text:
+        return
     try:
         bot.edit_message_text(
             chat_id=task_message.chat.id,
@@ -115,5 +183,23 @@ def update_task_progress(event: Optional[TaskProgressEvent], task_message_pk: UU
             text=msg_text,
         )
     except ApiTelegramException as exc:
+        if exc.error_code == 429:
+            retry_after = exc.result_json.get('parameters', {}).get('retry_after', 1)
+            raise self.retry(countdown=retry_after) from exc
         if exc.error_code != 400:
             raise
+    TaskMessage.objects.filter(pk=task_message_pk).update(status_text=msg_text, status_flushed_at=timezone.now())
+
+
+@shared_task(acks_late=True, ignore_result=True, bind=True)
+def dispatch_task_messages(self: Task) -> None:
+    """Starts queued task messages for which there is capacity. Runs on new and finished messages, and periodically."""
+
+    try:
+        with single_flight('telegram:dispatch'):
+            started_task_message_pks = scheduler.dispatch()
+    except InFlight as exc:
+        # The running dispatch may have missed the change this one was triggered by
+        raise self.retry(countdown=1, max_retries=None) from exc
+    for task_message_pk in started_task_message_pks:
+        update_task_progress.delay(None, task_message_pk)
@@ -5,8 +5,16 @@ from video_helpers import models
 
 @admin.register(models.VideoFile)
 class VideoFileAdmin(admin.ModelAdmin):
-    list_display = ['id', 'duration', 'width', 'height', 'last_used_at']
-    fields = ['id', ('duration', 'width', 'height'), 'file']
-    sortable_by = ['id', 'duration', 'last_used_at']
-    readonly_fields = ['last_used_at']
+    list_display = ['id', 'duration', 'width', 'height', 'size_bytes', 'last_used_at']
+    fields = [
+        'id', ('duration', 'width', 'height'), 'file', 'size_bytes', 'source_offset_ms',
+        ('video_codec', 'pix_fmt', 'fps', 'rotation', 'bitrate'),
+        ('audio_codec', 'audio_sample_rate', 'audio_channels'),
+    ]
+    sortable_by = ['id', 'duration', 'size_bytes', 'last_used_at']
+    readonly_fields = [
+        'size_bytes', 'last_used_at', 'source_offset_ms',
+        'video_codec', 'pix_fmt', 'fps', 'rotation', 'bitrate',
+        'audio_codec', 'audio_sample_rate', 'audio_channels',
+    ]
     view_on_site = False
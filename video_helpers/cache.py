@@ -0,0 +1,161 @@
+import itertools
+import logging
+import os
+import time
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from typing import List, Iterator, Iterable, TypeVar
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+
+from video_helpers.checkpoints import delete_checkpoints
+from video_helpers.models import VideoFile
+from video_helpers.staging import total_staging_reserved_bytes
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+def cache_usage_bytes() -> int:
+    """Returns the size of stored videos and of the space reserved for the videos being produced."""
+
+    stored_bytes = VideoFile.objects.aggregate(total=Sum('size_bytes'))['total'] or 0
+    return stored_bytes + total_staging_reserved_bytes()
+
+
+def _delete_files_on_commit(file_names: List[str]) -> None:
+    def delete_files() -> None:
+        for file_name in file_names:
+            Path(settings.MEDIA_ROOT, file_name).unlink(missing_ok=True)
+
+    transaction.on_commit(delete_files)
+
+
+def evict_videos(max_total_bytes: int) -> int:
+    """Deletes least recently used videos until the cache takes no more than max_total_bytes.
+
+    Videos are deleted in batches of VIDEO_CACHE_BATCH_SIZE, each in its own short transaction, and their
+    files are removed once the batch is committed. Rows locked by running tasks are skipped, and videos used
+    within VIDEO_CACHE_MIN_IDLE are never evicted, as they may be inputs of running tasks.
+    Returns the number of freed bytes.
+    """
+
+    total_bytes = cache_usage_bytes()
+    freed_bytes = 0
+    evicted_count = 0
+    while total_bytes - freed_bytes > max_total_bytes:
+        with transaction.atomic():
+            candidates = (
+                VideoFile.objects
+                .select_for_update(skip_locked=True)
+                .filter(last_used_at__lt=datetime.utcnow() - settings.VIDEO_CACHE_MIN_IDLE)
+                .order_by('last_used_at')
+                .values_list('id', 'file', 'size_bytes')
+                [:settings.VIDEO_CACHE_BATCH_SIZE]
+            )
+            video_ids: List[str] = []
+            file_names: List[str] = []
+            for video_id, file_name, size_bytes in candidates:
+                if total_bytes - freed_bytes <= max_total_bytes:
+                    break
+                video_ids.append(video_id)
+                file_names.append(file_name)
+                freed_bytes += size_bytes
+            if not video_ids:
+                break
+            VideoFile.objects.filter(id__in=video_ids).delete()
+            _delete_files_on_commit(file_names)
+            transaction.on_commit(partial(delete_checkpoints, video_ids))
+        evicted_count += len(video_ids)
+
+    if evicted_count:
+        logger.info(f"Evicted {evicted_count} videos, {freed_bytes} bytes freed")
+    return freed_bytes
+
+
+def enforce_cache_budget() -> int:
+    """Evicts videos down to the low watermark once the cache grows over the high watermark."""
+
+    if cache_usage_bytes() <= settings.VIDEO_CACHE_MAX_BYTES * settings.VIDEO_CACHE_HIGH_WATERMARK:
+        return 0
+    return evict_videos(int(settings.VIDEO_CACHE_MAX_BYTES * settings.VIDEO_CACHE_LOW_WATERMARK))
+
+
+def reserve_cache_space(required_bytes: int) -> int:
+    """Makes room for a new file of required_bytes, evicting videos if it would not fit into the budget."""
+
+    if cache_usage_bytes() + required_bytes <= settings.VIDEO_CACHE_MAX_BYTES * settings.VIDEO_CACHE_HIGH_WATERMARK:
+        return 0
+    low_watermark_bytes = int(settings.VIDEO_CACHE_MAX_BYTES * settings.VIDEO_CACHE_LOW_WATERMARK)
+    return evict_videos(max(low_watermark_bytes - required_bytes, 0))
+
+
+def _iter_media_files() -> Iterator[os.DirEntry]:
+    with os.scandir(settings.MEDIA_ROOT) as entries:
+        for entry in entries:
+            # Dot-entries are service directories and temporary files, they are never referenced by videos
+            if not entry.name.startswith('.') and entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+def _batched(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def delete_orphan_files() -> int:
+    """Deletes files in MEDIA_ROOT not referenced by any video.
+
+    Files modified within VIDEO_RECONCILE_GRACE are skipped, as they may still be written by a running task.
+    """
+
+    modified_before = time.time() - settings.VIDEO_RECONCILE_GRACE.total_seconds()
+    deleted_count = 0
+    for entries in _batched(_iter_media_files(), settings.VIDEO_CACHE_BATCH_SIZE):
+        file_names = {entry.name: entry for entry in entries}
+        known_file_names = set(VideoFile.objects.filter(file__in=file_names.keys()).values_list('file', flat=True))
+        for file_name, entry in file_names.items():
+            if file_name in known_file_names:
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime >= modified_before:
+                    continue
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+            deleted_count += 1
+    logger.info(f"Deleted {deleted_count} orphan files")
+    return deleted_count
+
+
+def delete_missing_videos() -> int:
+    """Deletes videos whose files are missing, e.g. after a worker crash."""
+
+    deleted_count = 0
+    last_video_id = ''
+    while True:
+        videos = list(
+            VideoFile.objects
+            .filter(id__gt=last_video_id)
+            .order_by('id')
+            .values_list('id', 'file')
+            [:settings.VIDEO_CACHE_BATCH_SIZE]
+        )
+        if not videos:
+            break
+        last_video_id = videos[-1][0]
+        missing_video_ids = [
+            video_id
+            for video_id, file_name in videos
+            if not Path(settings.MEDIA_ROOT, file_name).exists()
+        ]
+        if missing_video_ids:
+            VideoFile.objects.filter(id__in=missing_video_ids).delete()
+            deleted_count += len(missing_video_ids)
+    logger.info(f"Deleted {deleted_count} videos with missing files")
+    return deleted_count
@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from django.conf import settings
+
+from video_helpers.staging import delete_dirs_modified_before
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+
+
+@dataclass(frozen=True)
+class SegmentedEncode:
+    """What every segment of a segmented encode is encoded with, fixed once the source is split."""
+
+    segment_names: List[str]
+    bitrate_kbps: int
+
+
+def checkpoint_dir(src_video_id: str, target_video_id: str) -> Path:
+    """Returns the directory of finished segments of the target video, inside the one of its source video.
+
+    Evicting the source deletes checkpoints of all videos made from it, as they can never be resumed.
+    """
+
+    return Path(settings.VIDEO_CHECKPOINT_DIR) / src_video_id / target_video_id
+
+
+def fsync_file(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_manifest(path: Path, encode: SegmentedEncode) -> None:
+    """Marks the split as finished: segments are resumed from the checkpoint only if it has a manifest."""
+
+    tmp_manifest_path = path / f".{MANIFEST_NAME}"
+    tmp_manifest_path.write_text(json.dumps(asdict(encode)))
+    fsync_file(tmp_manifest_path)
+    os.replace(tmp_manifest_path, path / MANIFEST_NAME)
+
+
+def read_manifest(path: Path) -> Optional[SegmentedEncode]:
+    try:
+        return SegmentedEncode(**json.loads((path / MANIFEST_NAME).read_text()))
+    except FileNotFoundError:
+        return None
+    except (ValueError, TypeError) as exc:
+        logger.warning(f"Checkpoint {path} has a broken manifest, starting over: {exc}")
+        return None
+
+
+def delete_checkpoints(video_ids: Iterable[str]) -> None:
+    for video_id in video_ids:
+        shutil.rmtree(Path(settings.VIDEO_CHECKPOINT_DIR) / video_id, ignore_errors=True)
+
+
+def delete_stale_checkpoints() -> int:
+    """Deletes checkpoints of encodes not resumed within VIDEO_CHECKPOINT_MAX_AGE."""
+
+    checkpoint_root = Path(settings.VIDEO_CHECKPOINT_DIR)
+    if not checkpoint_root.exists():
+        return 0
+
+    modified_before = time.time() - settings.VIDEO_CHECKPOINT_MAX_AGE.total_seconds()
+    deleted_count = 0
+    for src_path in checkpoint_root.iterdir():
+        deleted_count += delete_dirs_modified_before(src_path, modified_before)
+        try:
+            src_path.rmdir()
+        except OSError:
+            pass
+    logger.info(f"Deleted {deleted_count} stale checkpoints")
+    return deleted_count
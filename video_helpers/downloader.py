@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Callable
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT = (3.05, 27)
+
+_session: Optional[requests.Session] = None  # pylint: disable=invalid-name
+_session_pid: Optional[int] = None  # pylint: disable=invalid-name
+
+
+class DownloadLimitExceeded(Exception):
+    """The file is larger than VIDEO_DOWNLOAD_MAX_BYTES or takes longer than VIDEO_DOWNLOAD_TIMEOUT to download."""
+
+
+def _get_session() -> requests.Session:
+    global _session, _session_pid  # pylint: disable=global-statement
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=settings.VIDEO_DOWNLOAD_CONNECTIONS)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _session_pid = os.getpid()
+    return _session
+
+
+def _parse_total_size(content_range: Optional[str]) -> Optional[int]:
+    match = re.fullmatch(r'bytes \d+-\d+/(\d+)', content_range or '')
+    return int(match.group(1)) if match else None
+
+
+def _check_size(size_bytes: int) -> None:
+    if size_bytes > settings.VIDEO_DOWNLOAD_MAX_BYTES:
+        raise DownloadLimitExceeded(f"File is larger than {settings.VIDEO_DOWNLOAD_MAX_BYTES} bytes")
+
+
+def _check_deadline(deadline: float) -> None:
+    if time.monotonic() > deadline:
+        raise DownloadLimitExceeded(f"Download takes longer than {settings.VIDEO_DOWNLOAD_TIMEOUT} seconds")
+
+
+@dataclass(frozen=True)
+class _Writer:
+    """Writes response bodies to a file at given offsets, checking the download limits."""
+
+    fd: int
+    deadline: float
+
+    def write(
+            self,
+            resp: requests.Response,
+            offset: int,
+            length: Optional[int] = None,
+            on_written: Optional[Callable[[int], None]] = None,
+    ) -> int:
+        """Writes the response body from offset, stops after length bytes if it is given."""
+
+        written = 0
+        with resp:
+            for chunk in resp.iter_content(chunk_size=settings.VIDEO_DOWNLOAD_CHUNK_BYTES):
+                if length is not None:
+                    chunk = chunk[:length - written]
+                os.pwrite(self.fd, chunk, offset + written)
+                written += len(chunk)
+                if on_written is not None:
+                    on_written(len(chunk))
+                _check_size(offset + written)
+                _check_deadline(self.deadline)
+                if length is not None and written >= length:
+                    break
+        if length is not None and written != length:
+            raise requests.ConnectionError(f"Connection closed after {written} of {length} bytes")
+        return written
+
+
+class _Progress:
+    """Downloaded bytes of every part, saved next to the file so that a retried download resumes from them.
+
+    The validator identifies the remote file, a download is not resumed if the file has changed since.
+    """
+
+    def __init__(self, path: Path, validator: Dict[str, Any], parts: List[List[int]]):
+        self.path = path
+        self.validator = validator
+        # [start, end, written] of every part, end is inclusive
+        self.parts = parts
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: Path, validator: Dict[str, Any]) -> Optional['_Progress']:
+        try:
+            data = json.loads(path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        if data.get('validator') != validator:
+            return None
+        return cls(path, validator, data['parts'])
+
+    def advance(self, part_n: int, written: int) -> None:
+        with self._lock:
+            self.parts[part_n][2] += written
+            self.save()
+
+    def save(self) -> None:
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        tmp_path.write_text(json.dumps(dict(validator=self.validator, parts=self.parts)))
+        os.replace(tmp_path, self.path)
+
+    @property
+    def written(self) -> int:
+        return sum(written for _, _, written in self.parts)
+
+
+def _request_part(url: str, writer: _Writer, progress: _Progress, part_n: int) -> int:
+    start, end, written = progress.parts[part_n]
+    resp = _get_session().get(
+        url,
+        headers={'Range': f"bytes={start + written}-{end}"},
+        stream=True,
+        timeout=REQUEST_TIMEOUT,
+    )
+    resp.raise_for_status()
+    if resp.status_code != requests.codes.partial_content:
+        resp.close()
+        raise requests.ConnectionError(f"Server ignored range {start + written}-{end}")
+    return writer.write(resp, start + written, end - start - written + 1, partial(progress.advance, part_n))
+
+
+def _split(total_size: int) -> List[List[int]]:
+    parts_count = max(1, min(
+        settings.VIDEO_DOWNLOAD_CONNECTIONS,
+        total_size // settings.VIDEO_DOWNLOAD_PART_MIN_BYTES,
+    ))
+    part_size = -(-total_size // parts_count)
+    return [
+        [start, min(start + part_size, total_size) - 1, 0]
+        for start in range(0, total_size, part_size)
+    ]
+
+
+def download(url: str, dst: Path) -> int:
+    """Downloads the file to dst, returns its size.
+
+    If the server supports range requests, large files are split into parts downloaded over
+    VIDEO_DOWNLOAD_CONNECTIONS connections at once. Connections are pooled per worker process.
+    Progress of ranged downloads is saved next to dst, and a download to the same dst resumes from it.
+    """
+
+    deadline = time.monotonic() + settings.VIDEO_DOWNLOAD_TIMEOUT
+    # An open-ended range tells whether the server supports ranges and the file size in one request
+    resp = _get_session().get(url, headers={'Range': 'bytes=0-'}, stream=True, timeout=REQUEST_TIMEOUT)
+    resp.raise_for_status()
+
+    total_size = None
+    if resp.status_code == requests.codes.partial_content:
+        total_size = _parse_total_size(resp.headers.get('Content-Range'))
+    elif 'Content-Length' in resp.headers:
+        total_size = int(resp.headers['Content-Length'])
+    if total_size is not None:
+        _check_size(total_size)
+
+    if resp.status_code != requests.codes.partial_content or total_size is None:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            return _Writer(fd, deadline).write(resp, 0, total_size)
+        finally:
+            os.close(fd)
+
+    progress_path = dst.with_name(f"{dst.name}.progress")
+    validator = dict(
+        url=url,
+        size=total_size,
+        etag=resp.headers.get('ETag'),
+        last_modified=resp.headers.get('Last-Modified'),
+    )
+    progress = _Progress.load(progress_path, validator) if dst.exists() else None
+    if progress is None:
+        progress = _Progress(progress_path, validator, _split(total_size))
+        progress.save()
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(fd, total_size)
+    else:
+        logger.info(f"Resuming download of {total_size} bytes from {progress.written} bytes")
+        fd = os.open(dst, os.O_WRONLY)
+
+    try:
+        writer = _Writer(fd, deadline)
+        pending_parts = [
+            part_n
+            for part_n, (start, end, written) in enumerate(progress.parts)
+            if written <= end - start
+        ]
+        logger.debug(f"Downloading {total_size} bytes in {len(pending_parts)} parts")
+        futures = []
+        probe_resp_used = False
+        with ThreadPoolExecutor(max_workers=max(len(pending_parts), 1)) as executor:
+            for part_n in pending_parts:
+                start, end, written = progress.parts[part_n]
+                if start + written == 0:
+                    probe_resp_used = True
+                    # The first part is read from the response of the probing request
+                    futures.append(executor.submit(writer.write, resp, 0, end + 1, partial(progress.advance, part_n)))
+                else:
+                    futures.append(executor.submit(_request_part, url, writer, progress, part_n))
+            if not probe_resp_used:
+                resp.close()
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+    progress_path.unlink(missing_ok=True)
+    return total_size
@@ -0,0 +1,484 @@
+import json
+import os
+import struct
+import subprocess
+import tempfile
+from dataclasses import dataclass
+from fractions import Fraction
+from pathlib import Path
+from typing import List, Optional, Sequence, Dict, Any, Tuple
+
+from django.conf import settings
+
+
+class FFmpegError(RuntimeError):
+    pass
+
+
+class SmartCutUnsupported(FFmpegError):
+    pass
+
+
+# Source video codec -> encoder arguments producing a compatible bitstream for the re-encoded edges
+SMART_CUT_ENCODERS = {
+    'h264': ['-c:v', 'libx264', '-preset', 'veryfast'],
+    'vp9': ['-c:v', 'libvpx-vp9', '-b:v', '0', '-deadline', 'realtime', '-cpu-used', '8', '-row-mt', '1'],
+}
+
+
+@dataclass(frozen=True)
+class MediaInfo:  # pylint: disable=too-many-instance-attributes
+    duration: float
+    # Display size, i.e. with rotation applied
+    width: int
+    height: int
+    size_bytes: int
+    bitrate: Optional[int]
+    video_codec: Optional[str]
+    pix_fmt: Optional[str]
+    fps: Optional[Fraction]
+    rotation: int
+    audio_codec: Optional[str]
+    audio_sample_rate: Optional[int]
+    audio_channels: Optional[int]
+
+    @property
+    def has_audio(self) -> bool:
+        return self.audio_codec is not None
+
+    @property
+    def stream_params(self) -> Tuple[Any, ...]:
+        """Parameters that must be equal for files to be joined without re-encoding."""
+        fps = round(float(self.fps), 2) if self.fps else None
+        return (
+            self.video_codec, self.width, self.height, fps, self.pix_fmt, self.rotation,
+            self.audio_codec, self.audio_sample_rate, self.audio_channels,
+        )
+
+
+@dataclass(frozen=True)
+class RenderInput:
+    path: Path
+    start: float = 0.0
+    end: Optional[float] = None
+    info: Optional[MediaInfo] = None
+
+
+def run_ffmpeg(args: Sequence[str]) -> None:
+    cmd = [settings.FFMPEG_BINARY, '-hide_banner', '-nostdin', '-loglevel', 'error', '-y', *args]
+    proc = subprocess.run(cmd, capture_output=True, text=True, check=False)
+    if proc.returncode != 0:
+        raise FFmpegError(f"ffmpeg exited with code {proc.returncode}: {proc.stderr.strip()[-1000:]}")
+
+
+def run_ffprobe(args: Sequence[str]) -> str:
+    cmd = [settings.FFPROBE_BINARY, '-hide_banner', '-loglevel', 'error', *args]
+    proc = subprocess.run(cmd, capture_output=True, text=True, check=False)
+    if proc.returncode != 0:
+        raise FFmpegError(f"ffprobe exited with code {proc.returncode}: {proc.stderr.strip()[-1000:]}")
+    return proc.stdout
+
+
+def _parse_fraction(value: Optional[str]) -> Optional[Fraction]:
+    if not value:
+        return None
+    try:
+        fraction = Fraction(value)
+    except (ValueError, ZeroDivisionError):
+        return None
+    return fraction or None
+
+
+def _parse_int(value: Any) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_rotation(video_stream: Dict[str, Any]) -> int:
+    rotation = _parse_int(video_stream.get('tags', {}).get('rotate'))
+    if rotation is None:
+        for side_data in video_stream.get('side_data_list', []):
+            rotation = _parse_int(side_data.get('rotation'))
+            if rotation is not None:
+                break
+    return (rotation or 0) % 360
+
+
+def probe(path: Path) -> MediaInfo:
+    """Reads container and stream metadata with ffprobe, without decoding any frames."""
+
+    output: Dict[str, Any] = json.loads(run_ffprobe([
+        '-print_format', 'json',
+        '-show_format',
+        '-show_streams',
+        str(path),
+    ]))
+    container: Dict[str, Any] = output.get('format', {})
+    streams: List[Dict[str, Any]] = output.get('streams', [])
+    video_stream = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio_stream: Dict[str, Any] = next((s for s in streams if s.get('codec_type') == 'audio'), {})
+    if video_stream is None:
+        raise FFmpegError(f"No video stream found in {path.name}")
+
+    rotation = _parse_rotation(video_stream)
+    width, height = int(video_stream['width']), int(video_stream['height'])
+    if rotation in (90, 270):
+        width, height = height, width
+
+    return MediaInfo(
+        duration=float(container.get('duration') or video_stream.get('duration') or 0),
+        width=width,
+        height=height,
+        size_bytes=_parse_int(container.get('size')) or path.stat().st_size,
+        bitrate=_parse_int(container.get('bit_rate')),
+        video_codec=video_stream.get('codec_name'),
+        pix_fmt=video_stream.get('pix_fmt'),
+        fps=_parse_fraction(video_stream.get('r_frame_rate')) or _parse_fraction(video_stream.get('avg_frame_rate')),
+        rotation=rotation,
+        audio_codec=audio_stream.get('codec_name'),
+        audio_sample_rate=_parse_int(audio_stream.get('sample_rate')),
+        audio_channels=_parse_int(audio_stream.get('channels')),
+    )
+
+
+def list_video_packets(path: Path, start: float = 0.0, end: Optional[float] = None) -> List[Tuple[float, bool]]:
+    """Returns (presentation timestamp, is keyframe) of video packets, reading packet headers only."""
+
+    read_interval = f"{max(start, 0.0):.6f}%" + (f"{end:.6f}" if end is not None else '')
+    output = run_ffprobe([
+        '-select_streams', 'v:0',
+        '-read_intervals', read_interval,
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=print_section=0',
+        str(path),
+    ])
+    packets: List[Tuple[float, bool]] = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.strip().partition(',')
+        if pts_time not in ('', 'N/A'):
+            packets.append((float(pts_time), 'K' in flags))
+    return sorted(packets)
+
+
+def _write_concat_list(parts: Sequence[Path], list_path: Path) -> None:
+    with list_path.open(mode='w') as file:
+        for part in parts:
+            escaped_path = str(part.resolve()).replace("'", "'\\''")
+            file.write(f"file '{escaped_path}'\n")
+
+
+def concat_copy(parts: Sequence[Path], dst: Path, extra_args: Sequence[str] = ()) -> None:
+    """Joins files with identical codec parameters using the concat demuxer, without re-encoding."""
+
+    list_path = dst.with_name(f"{dst.stem}.concat.txt")
+    _write_concat_list(parts, list_path)
+    try:
+        run_ffmpeg([
+            '-f', 'concat', '-safe', '0', '-i', str(list_path),
+            '-map', '0:v:0', '-map', '0:a:0?',
+            '-c', 'copy',
+            *extra_args,
+            str(dst),
+        ])
+    finally:
+        list_path.unlink(missing_ok=True)
+
+
+def split_video(src: Path, dst_dir: Path, segment_seconds: float) -> List[Path]:
+    """Splits the video stream of src without re-encoding, at the first keyframe after every segment_seconds."""
+
+    run_ffmpeg([
+        '-i', str(src),
+        '-map', '0:v:0',
+        '-c', 'copy',
+        '-f', 'segment', '-segment_time', f"{segment_seconds:.3f}", '-reset_timestamps', '1',
+        str(dst_dir / 'src%05d.mkv'),
+    ])
+    return sorted(dst_dir.glob('src*.mkv'))
+
+
+def encode_video_stream(src: Path, dst: Path, *, encoder_args: Sequence[str], threads: int = 1) -> None:
+    run_ffmpeg([
+        '-i', str(src),
+        '-map', '0:v:0',
+        *encoder_args,
+        '-threads', str(threads),
+        str(dst),
+    ])
+
+
+def join_video_parts(
+        parts: Sequence[Path],
+        audio_src: Path,
+        dst: Path,
+        *,
+        audio_args: Sequence[str],
+        extra_args: Sequence[str] = (),
+) -> None:
+    """Joins video-only parts without re-encoding, adding the audio of audio_src encoded in one piece."""
+
+    list_path = dst.with_name(f"{dst.stem}.concat.txt")
+    _write_concat_list(parts, list_path)
+    try:
+        run_ffmpeg([
+            '-f', 'concat', '-safe', '0', '-i', str(list_path),
+            '-i', str(audio_src),
+            '-map', '0:v:0', '-map', '1:a:0?',
+            '-c:v', 'copy',
+            *audio_args,
+            *extra_args,
+            str(dst),
+        ])
+    finally:
+        list_path.unlink(missing_ok=True)
+
+
+def remux(src: Path, dst: Path, extra_args: Sequence[str] = ()) -> None:
+    """Copies the first video and audio streams into the container of dst, without re-encoding."""
+
+    run_ffmpeg([
+        '-i', str(src),
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-c', 'copy',
+        *extra_args,
+        str(dst),
+    ])
+
+
+def is_faststart(path: Path) -> bool:
+    """Tells whether the index (moov box) of an MP4 file comes before the media data, so playback can start early."""
+
+    with path.open('rb') as file:
+        while True:
+            header = file.read(8)
+            if len(header) < 8:
+                return False
+            size, box_type = struct.unpack('>I4s', header)
+            if box_type == b'moov':
+                return True
+            if box_type == b'mdat':
+                return False
+            header_size = 8
+            if size == 1:
+                size, = struct.unpack('>Q', file.read(8))
+                header_size = 16
+            # A box extending to the end of the file or a malformed size leaves no moov box to find
+            if size < header_size:
+                return False
+            file.seek(size - header_size, os.SEEK_CUR)
+
+
+def download_segment(
+        streams: Sequence[Tuple[str, Dict[str, str]]],
+        dst: Path,
+        start: float,
+        end: Optional[float],
+) -> float:
+    """Downloads [start, end) of remote streams (video first, then audio), returns the actual segment start.
+
+    FFmpeg seeks over HTTP with range requests, so only the bytes covering the range are fetched. Streams are
+    copied starting from the keyframe preceding ``start``, so the segment may start a bit earlier than requested;
+    positions within the segment are relative to the returned start.
+    """
+
+    input_args: List[str] = []
+    for url, headers in streams:
+        if headers:
+            input_args += ['-headers', ''.join(f"{name}: {value}\r\n" for name, value in headers.items())]
+        input_args += ['-ss', f"{start:.6f}"]
+        if end is not None:
+            input_args += ['-t', f"{end - start:.6f}"]
+        input_args += ['-i', url]
+
+    with tempfile.TemporaryDirectory(dir=dst.parent) as tmp_dir:
+        # Source timestamps are kept to find out where the segment actually starts, then reset to zero
+        raw_path = Path(tmp_dir) / f"raw{dst.suffix}"
+        run_ffmpeg([
+            *input_args,
+            '-map', '0:v:0', '-map', f"{len(streams) - 1}:a:0?",
+            '-c', 'copy',
+            '-copyts',
+            str(raw_path),
+        ])
+        segment_format = json.loads(run_ffprobe(['-show_format', '-print_format', 'json', str(raw_path)]))['format']
+        run_ffmpeg(['-i', str(raw_path), '-map', '0', '-c', 'copy', str(dst)])
+    try:
+        return float(segment_format['start_time'])
+    except (KeyError, ValueError):
+        return start
+
+
+def sample_bitrate(samples: Sequence[RenderInput], *, encoder_args: Sequence[str], threads: int = 1) -> float:
+    """Encodes the video of every sample and returns the bitrate of the results in bits per second.
+
+    Samples must have an end. The bitrate includes a few bytes of container overhead per sample.
+    """
+
+    total_bytes = 0
+    total_duration = 0.0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n, sample in enumerate(samples):
+            if sample.end is None:
+                raise ValueError(f"Sample {n} has no end")
+            sample_path = Path(tmp_dir) / f"sample{n}.mkv"
+            run_ffmpeg([
+                '-ss', f"{sample.start:.6f}", '-t', f"{sample.end - sample.start:.6f}", '-i', str(sample.path),
+                '-map', '0:v:0', '-an',
+                *encoder_args,
+                '-threads', str(threads),
+                str(sample_path),
+            ])
+            total_bytes += sample_path.stat().st_size
+            total_duration += sample.end - sample.start
+    if total_duration <= 0:
+        raise FFmpegError('Samples are empty')
+    return total_bytes * 8 / total_duration
+
+
+def can_concat_copy(infos: Sequence[MediaInfo]) -> bool:
+    return len({info.stream_params for info in infos}) == 1
+
+
+def smart_cut(  # pylint: disable=too-many-arguments
+        src: Path,
+        dst: Path,
+        start: float,
+        end: Optional[float],
+        *,
+        info: Optional[MediaInfo] = None,
+        threads: int = 1,
+) -> None:
+    """Cuts [start, end) out of src, copying whole GOPs and re-encoding only the partial ones at the edges.
+
+    Video is split at the first keyframe after ``start`` and the last keyframe before ``end``: the middle
+    part is stream-copied and the edges are re-encoded with an encoder matching the source codec. Parts are
+    joined by the concat demuxer, which converts H.264 parts to Annex B so that each one keeps its own
+    parameter sets. Audio is cheap to encode and is always re-encoded for the exact range.
+    """
+
+    if info is None:
+        info = probe(src)
+    if info.video_codec not in SMART_CUT_ENCODERS:
+        raise SmartCutUnsupported(f"Smart cut is not supported for {info.video_codec} streams")
+    # Re-encoded edges would be autorotated, while the copied middle keeps the coded orientation
+    if info.rotation:
+        raise SmartCutUnsupported(f"Smart cut is not supported for streams rotated by {info.rotation} degrees")
+
+    if end is None or end > info.duration:
+        end = info.duration
+    if end <= start:
+        raise FFmpegError(f"Empty cut range: {start:.3f}-{end:.3f}")
+    # Half a frame of tolerance so that a keyframe exactly on the cut point is not treated as partial
+    epsilon = float(1 / info.fps / 2) if info.fps else 0.001
+
+    packets = list_video_packets(src, start, end)
+    inner_keyframes = [pts for pts, is_key in packets if is_key and start - epsilon <= pts <= end + epsilon]
+
+    encoder_args = [
+        *SMART_CUT_ENCODERS[info.video_codec],
+        '-crf', str(settings.VIDEO_SMART_CUT_CRF),
+        '-threads', str(threads),
+    ]
+    if info.pix_fmt:
+        encoder_args += ['-pix_fmt', info.pix_fmt]
+
+    with tempfile.TemporaryDirectory(dir=dst.parent) as tmp_dir:
+        tmp_dir_path = Path(tmp_dir)
+        parts: List[Path] = []
+
+        def encode_part(part_start: float, part_end: float) -> None:
+            part_path = tmp_dir_path / f"part{len(parts)}.mkv"
+            run_ffmpeg([
+                '-ss', f"{part_start:.6f}", '-i', str(src),
+                '-t', f"{part_end - part_start:.6f}",
+                '-map', '0:v:0', '-an', '-sn', '-dn',
+                *encoder_args,
+                str(part_path),
+            ])
+            parts.append(part_path)
+
+        def copy_part(part_start: float, part_end: float) -> None:
+            # Packets are copied in decode order, so a frame count (unlike a duration) stops exactly at the
+            # end of the last whole GOP even when B-frames reorder timestamps around it
+            frames_count = sum(1 for pts, _ in packets if part_start - epsilon <= pts < part_end - epsilon)
+            part_path = tmp_dir_path / f"part{len(parts)}.mkv"
+            run_ffmpeg([
+                '-ss', f"{part_start:.6f}", '-i', str(src),
+                '-map', '0:v:0', '-an', '-sn', '-dn',
+                '-c:v', 'copy',
+                '-frames:v', str(frames_count),
+                str(part_path),
+            ])
+            parts.append(part_path)
+
+        if len(inner_keyframes) < 2:
+            encode_part(start, end)
+        else:
+            copy_from, copy_to = inner_keyframes[0], inner_keyframes[-1]
+            if copy_from - start > epsilon:
+                encode_part(start, copy_from)
+            copy_part(copy_from, copy_to)
+            if end - copy_to > epsilon:
+                encode_part(copy_to, end)
+
+        video_path = tmp_dir_path / 'video.mkv'
+        concat_copy(parts, video_path)
+
+        run_ffmpeg([
+            '-i', str(video_path),
+            '-ss', f"{start:.6f}", '-t', f"{end - start:.6f}", '-i', str(src),
+            '-map', '0:v:0', '-map', '1:a:0?',
+            '-c:v', 'copy',
+            '-c:a', 'aac',
+            '-movflags', '+faststart',
+            str(dst),
+        ])
+
+
+def render(inputs: Sequence[RenderInput], dst: Path, *, encoder_args: Sequence[str], threads: int = 1) -> None:
+    """Cuts, scales and concatenates inputs and encodes the result in a single decode/filter/encode pass.
+
+    Inputs of different sizes are letterboxed into the largest frame, like MoviePy's "compose" concatenation.
+    Inputs without audio get silence so that audio and video stay in sync across the joins.
+    """
+
+    infos = [item.info or probe(item.path) for item in inputs]
+    width = max(info.width for info in infos)
+    width += width % 2
+    height = max(info.height for info in infos)
+    height += height % 2
+    fps = max((info.fps for info in infos if info.fps), default=Fraction(30))
+
+    input_args: List[str] = []
+    filters: List[str] = []
+    concat_pads: List[str] = []
+    for n, (item, info) in enumerate(zip(inputs, infos)):
+        end = min(item.end, info.duration) if item.end is not None else info.duration
+        duration = end - item.start
+        if duration <= 0:
+            raise FFmpegError(f"Empty cut range for {item.path.name}: {item.start:.3f}-{end:.3f}")
+        input_args += ['-ss', f"{item.start:.6f}", '-t', f"{duration:.6f}", '-i', str(item.path)]
+        filters.append(
+            f"[{n}:v:0]scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={fps},format=yuv420p[v{n}]"
+        )
+        if info.has_audio:
+            filters.append(
+                f"[{n}:a:0]aformat=sample_rates=44100:channel_layouts=stereo,"
+                f"apad,atrim=duration={duration:.6f}[a{n}]"
+            )
+        else:
+            filters.append(f"anullsrc=r=44100:cl=stereo,atrim=duration={duration:.6f}[a{n}]")
+        concat_pads.append(f"[v{n}][a{n}]")
+    filters.append(f"{''.join(concat_pads)}concat=n={len(inputs)}:v=1:a=1[v][a]")
+
+    run_ffmpeg([
+        *input_args,
+        '-filter_complex', ';'.join(filters),
+        '-map', '[v]', '-map', '[a]',
+        *encoder_args,
+        '-threads', str(threads),
+        str(dst),
+    ])
@@ -0,0 +1,69 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import redis
+from django.conf import settings
+from redis.exceptions import LockError
+
+logger = logging.getLogger(__name__)
+
+_redis_client: Optional[redis.Redis] = None  # pylint: disable=invalid-name
+_redis_client_pid: Optional[int] = None  # pylint: disable=invalid-name
+
+
+class InFlight(Exception):
+    """Another worker is already producing the same result."""
+
+
+def _get_redis() -> redis.Redis:
+    global _redis_client, _redis_client_pid  # pylint: disable=global-statement
+    if _redis_client is None or _redis_client_pid != os.getpid():
+        _redis_client = redis.Redis.from_url(settings.VIDEO_LOCK_REDIS_URL)
+        _redis_client_pid = os.getpid()
+    return _redis_client
+
+
+@contextmanager
+def single_flight(key: str) -> Iterator[None]:
+    """Makes sure that only one worker at a time runs the block for the key, raises InFlight otherwise.
+
+    The Redis lock expires VIDEO_LOCK_TIMEOUT seconds after the last heartbeat, so a lock held by a crashed
+    worker is released in time for the redelivered task. Locking is disabled if VIDEO_LOCK_REDIS_URL is empty.
+    """
+
+    if not settings.VIDEO_LOCK_REDIS_URL:
+        yield
+        return
+
+    lock = _get_redis().lock(
+        name=f"video_helpers:single_flight:{key}",
+        timeout=settings.VIDEO_LOCK_TIMEOUT,
+        thread_local=False,
+    )
+    if not lock.acquire(blocking=False):
+        raise InFlight(key)
+
+    stopped = threading.Event()
+
+    def heartbeat() -> None:
+        while not stopped.wait(settings.VIDEO_LOCK_TIMEOUT / 3):
+            try:
+                lock.reacquire()
+            except LockError:
+                logger.warning(f"Single-flight lock {key} is lost")
+                return
+
+    heartbeat_thread = threading.Thread(target=heartbeat, name=f"single-flight-{key}", daemon=True)
+    heartbeat_thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        heartbeat_thread.join()
+        try:
+            lock.release()
+        except LockError:
+            pass
@@ -0,0 +1,30 @@
+# Generated by Django 4.0.5 on 2026-10-16 22:37
+
+from django.db import migrations, models
+
+
+def fill_size_bytes(apps, schema_editor):
+    _ = schema_editor
+    VideoFile = apps.get_model('video_helpers', 'VideoFile')
+    for video in VideoFile.objects.only('id', 'file').iterator():
+        try:
+            video.size_bytes = video.file.size
+        except OSError:
+            continue
+        video.save(update_fields=('size_bytes',))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_helpers', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videofile',
+            name='size_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_size_bytes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.0.5 on 2026-10-16 22:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_helpers', '0002_videofile_size_bytes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videofile',
+            name='audio_channels',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='audio_codec',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='audio_sample_rate',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='bitrate',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='fps',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='pix_fmt',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='rotation',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='video_codec',
+            field=models.TextField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='videofile',
+            name='duration',
+            field=models.FloatField(),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-16 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_helpers', '0003_videofile_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videofile',
+            name='source_offset_ms',
+            field=models.IntegerField(default=0),
+        ),
+    ]
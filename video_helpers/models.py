@@ -1,10 +1,79 @@
+from __future__ import annotations
+
+from fractions import Fraction
+from pathlib import Path
+from typing import Any
+
 from django.db import models
 
+from video_helpers.ffmpeg import MediaInfo, probe
+
 
 class VideoFile(models.Model):
+    METADATA_FIELDS = (
+        'duration', 'width', 'height', 'size_bytes', 'bitrate', 'video_codec', 'pix_fmt', 'fps', 'rotation',
+        'audio_codec', 'audio_sample_rate', 'audio_channels',
+    )
+
     id = models.SlugField(primary_key=True)
-    duration = models.IntegerField()
+    duration = models.FloatField()
     width = models.IntegerField()
     height = models.IntegerField()
     file = models.FileField()
+    size_bytes = models.BigIntegerField(default=0)
     last_used_at = models.DateTimeField(auto_now=True)
+    # Position of the file's start in the source video, for videos downloaded as a segment
+    source_offset_ms = models.IntegerField(default=0)
+
+    bitrate = models.IntegerField(null=True)
+    video_codec = models.TextField(null=True)
+    pix_fmt = models.TextField(null=True)
+    fps = models.FloatField(null=True)
+    rotation = models.IntegerField(default=0)
+    audio_codec = models.TextField(null=True)
+    audio_sample_rate = models.IntegerField(null=True)
+    audio_channels = models.IntegerField(null=True)
+
+    @classmethod
+    def from_media_info(cls, info: MediaInfo, **kwargs: Any) -> VideoFile:
+        return cls(
+            duration=info.duration,
+            width=info.width,
+            height=info.height,
+            size_bytes=info.size_bytes,
+            bitrate=info.bitrate,
+            video_codec=info.video_codec,
+            pix_fmt=info.pix_fmt,
+            fps=float(info.fps) if info.fps else None,
+            rotation=info.rotation,
+            audio_codec=info.audio_codec,
+            audio_sample_rate=info.audio_sample_rate,
+            audio_channels=info.audio_channels,
+            **kwargs,
+        )
+
+    def media_info(self) -> MediaInfo:
+        """Returns stored stream metadata, probing the file only for videos stored before it was collected."""
+
+        if self.video_codec is None:
+            info = probe(Path(self.file.path))
+            probed_video = VideoFile.from_media_info(info)
+            for field in self.METADATA_FIELDS:
+                setattr(self, field, getattr(probed_video, field))
+            self.save(update_fields=self.METADATA_FIELDS)
+            return info
+
+        return MediaInfo(
+            duration=self.duration,
+            width=self.width,
+            height=self.height,
+            size_bytes=self.size_bytes,
+            bitrate=self.bitrate,
+            video_codec=self.video_codec,
+            pix_fmt=self.pix_fmt,
+            fps=Fraction(self.fps).limit_denominator(1001) if self.fps else None,
+            rotation=self.rotation,
+            audio_codec=self.audio_codec,
+            audio_sample_rate=self.audio_sample_rate,
+            audio_channels=self.audio_channels,
+        )
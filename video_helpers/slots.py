@@ -0,0 +1,75 @@
+import fcntl
+import logging
+from contextlib import contextmanager, ExitStack
+from pathlib import Path
+from typing import Iterator, Optional, TextIO
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _try_lock(path: Path) -> Optional[TextIO]:
+    file = path.open(mode='a')
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        file.close()
+        return None
+    return file
+
+
+def _slot_threads(path: Path) -> int:
+    try:
+        return int(path.read_text() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _busy_threads(slots_dir: Path) -> int:
+    """Returns the number of threads the encodes of the busy slots use."""
+
+    busy_threads = 0
+    for slot_n in range(settings.VIDEO_ENCODER_SLOTS):
+        slot_path = slots_dir / f"slot{slot_n}.lock"
+        file = _try_lock(slot_path)
+        if file is None:
+            busy_threads += _slot_threads(slot_path)
+        else:
+            file.close()
+    return busy_threads
+
+
+@contextmanager
+def encoder_threads() -> Iterator[int]:
+    """Occupies one of the host's encoder slots and yields the number of threads the encoder may use.
+
+    Slots are lock files shared by all worker processes of the host, so they are released by the OS even if
+    a worker dies. Thread counts are fixed for the whole encode, so an encode gets the budget left by the busy
+    slots: a lone job gets all of it, and later jobs get at least an equal share of the budget, oversubscribing
+    the cores by at most that share per extra job until the earlier ones finish.
+    """
+
+    budget = settings.VIDEO_ENCODER_CORE_BUDGET
+    slots_count = settings.VIDEO_ENCODER_SLOTS
+    slots_dir = Path(settings.VIDEO_ENCODER_SLOTS_DIR)
+    slots_dir.mkdir(parents=True, exist_ok=True)
+    with ExitStack() as stack:
+        # Slots are taken one at a time, so that every encode sees the thread counts of the ones started before
+        with (slots_dir / 'allocate.lock').open(mode='a') as allocate_file:
+            fcntl.flock(allocate_file, fcntl.LOCK_EX)
+            busy_threads = _busy_threads(slots_dir)
+            for slot_n in range(slots_count):
+                slot_file = _try_lock(slots_dir / f"slot{slot_n}.lock")
+                if slot_file is not None:
+                    stack.callback(slot_file.close)
+                    threads = max(budget - busy_threads, budget // slots_count, 1)
+                    slot_file.truncate(0)
+                    slot_file.write(str(threads))
+                    slot_file.flush()
+                    break
+            else:
+                # More encodes than slots run only if workers are misconfigured, keep them from adding much load
+                logger.warning(f"All {slots_count} encoder slots are busy, encoding with a single thread")
+                threads = 1
+        yield threads
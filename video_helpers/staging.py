@@ -0,0 +1,118 @@
+import errno
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Estimated size of the video produced in a staging directory, counted against the cache until it is ingested
+RESERVATION_FILE_NAME = '.reserved'
+
+
+@contextmanager
+def staging_dir(video_id: str, *, resumable: bool = False) -> Iterator[Path]:
+    """Yields a working directory for producing the video, on the same filesystem as MEDIA_ROOT by default.
+
+    The directory is deleted once the block is done. If the work is resumable, the directory is kept after
+    a failure for the next attempt to resume from, as well as after a worker crash in any case. Such directories
+    are deleted by delete_stale_staging_dirs if no attempt comes within VIDEO_STAGING_MAX_AGE.
+    """
+
+    path = Path(settings.VIDEO_STAGING_DIR) / video_id
+    path.mkdir(parents=True, exist_ok=True)
+    try:
+        yield path
+    except BaseException:
+        if not resumable:
+            shutil.rmtree(path, ignore_errors=True)
+        raise
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def reserve_staging_space(path: Path, size_bytes: int) -> None:
+    """Records that the video produced in the staging directory is expected to take size_bytes."""
+
+    (path / RESERVATION_FILE_NAME).write_text(str(size_bytes))
+
+
+def staging_reserved_bytes(path: Path) -> int:
+    try:
+        return int((path / RESERVATION_FILE_NAME).read_text() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def total_staging_reserved_bytes() -> int:
+    """Returns the bytes reserved by the videos being produced in all staging directories."""
+
+    staging_root = Path(settings.VIDEO_STAGING_DIR)
+    if not staging_root.exists():
+        return 0
+    return sum(staging_reserved_bytes(path) for path in staging_root.iterdir())
+
+
+def ingest_file(src: Path) -> str:
+    """Moves the file into MEDIA_ROOT under its own name, returns the name for the FileField.
+
+    The file is renamed without copying if it is on the same filesystem as MEDIA_ROOT, and is copied next to
+    its destination first otherwise, so that a half-written file never appears in MEDIA_ROOT under its name.
+    """
+
+    dst = Path(settings.MEDIA_ROOT) / src.name
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.replace(src, dst)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        # Dot-files are skipped by reconciliation while being copied
+        tmp_dst = dst.with_name(f".{dst.name}.ingest")
+        shutil.copyfile(src, tmp_dst)
+        os.replace(tmp_dst, dst)
+        src.unlink()
+    return dst.name
+
+
+def _last_modified_at(path: Path) -> float:
+    modified_at = path.stat().st_mtime
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                modified_at = max(modified_at, Path(dir_path, file_name).stat().st_mtime)
+            except FileNotFoundError:
+                continue
+    return modified_at
+
+
+def delete_dirs_modified_before(root: Path, modified_before: float) -> int:
+    """Deletes directories in root with nothing in them modified since the timestamp."""
+
+    deleted_count = 0
+    for path in root.iterdir():
+        try:
+            if _last_modified_at(path) >= modified_before:
+                continue
+        except FileNotFoundError:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        deleted_count += 1
+    return deleted_count
+
+
+def delete_stale_staging_dirs() -> int:
+    """Deletes staging directories of abandoned attempts, i.e. not modified within VIDEO_STAGING_MAX_AGE."""
+
+    staging_root = Path(settings.VIDEO_STAGING_DIR)
+    if not staging_root.exists():
+        return 0
+
+    modified_before = time.time() - settings.VIDEO_STAGING_MAX_AGE.total_seconds()
+    deleted_count = delete_dirs_modified_before(staging_root, modified_before)
+    logger.info(f"Deleted {deleted_count} stale staging directories")
+    return deleted_count
@@ -1,20 +1,33 @@
-import tempfile
-from datetime import datetime, timedelta
+import os
+import shutil
+from contextlib import contextmanager
 from enum import Enum
 from pathlib import Path
-from typing import Optional, List, NewType
+from typing import Optional, List, NewType, Tuple, Iterator, Dict, Sequence
 
 import requests
+import sentry_sdk
 import youtube_dl
-from celery import shared_task
+from celery import shared_task, Task
+from celery.canvas import chord
+from celery.exceptions import Retry
 from celery.utils.log import get_task_logger
 from django.conf import settings
-from django.core.files import File
-from django.db import transaction
 from moviepy.editor import VideoFileClip, concatenate_videoclips
 from youtube_dl.utils import DownloadError
 
+from video_helpers.cache import enforce_cache_budget, reserve_cache_space, delete_missing_videos, delete_orphan_files
+from video_helpers.checkpoints import SegmentedEncode, checkpoint_dir, delete_stale_checkpoints, fsync_file, \
+    read_manifest, write_manifest
+from video_helpers.downloader import download
+from video_helpers.ffmpeg import FFmpegError, SmartCutUnsupported, MediaInfo, RenderInput, can_concat_copy, \
+    concat_copy, download_segment, encode_video_stream, is_faststart, join_video_parts, probe, remux, render, \
+    sample_bitrate, smart_cut, split_video
+from video_helpers.locks import InFlight, single_flight
 from video_helpers.models import VideoFile
+from video_helpers.slots import encoder_threads
+from video_helpers.staging import delete_stale_staging_dirs, ingest_file, reserve_staging_space, staging_dir, \
+    staging_reserved_bytes
 from video_helpers.utils import hashed
 
 logger = get_task_logger(__name__)
@@ -25,131 +38,230 @@ VideoId = NewType('VideoId', str)
 
 @shared_task(acks_late=True, ignore_result=True)
 def cleanup_old_videos() -> None:
-    files_to_remove: List[Path] = []
-
-    def delete_files() -> None:
-        for file in files_to_remove:
-            file.unlink()
-
-    with transaction.atomic():
-        transaction.on_commit(delete_files)
-        videos = (
-            VideoFile.objects
-            .filter(last_used_at__lt=datetime.utcnow() - timedelta(days=3))
-            .order_by('last_used_at')
-        )
-        for video in videos:
-            video.delete()
-            files_to_remove.append(Path(video.file.path))
+    freed_bytes = enforce_cache_budget()
+    logger.info(f"Cache cleanup: {freed_bytes} bytes freed")
+
+
+@shared_task(acks_late=True, ignore_result=True)
+def reconcile_video_files() -> None:
+    deleted_videos_count = delete_missing_videos()
+    deleted_files_count = delete_orphan_files()
+    deleted_staging_dirs_count = delete_stale_staging_dirs()
+    deleted_checkpoints_count = delete_stale_checkpoints()
+    logger.info(
+        f"Cache reconciliation: deleted {deleted_videos_count} videos without files"
+        f", {deleted_files_count} files without videos"
+        f", {deleted_staging_dirs_count} abandoned staging directories"
+        f" and {deleted_checkpoints_count} stale checkpoints"
+    )
+
+
+@contextmanager
+def _single_flight_or_retry(task: Task, video_id: str) -> Iterator[None]:
+    """Runs the block as the only producer of the video, or retries the task after the current producer is done."""
+    try:
+        with single_flight(video_id):
+            yield
+    except InFlight as exc:
+        logger.debug(f"Video {video_id} is being produced by another worker, retrying later")
+        if task.request.called_directly:
+            raise
+        raise _resend(task, countdown=settings.VIDEO_LOCK_RETRY_DELAY) from exc
+
+
+def _resend(task: Task, countdown: float) -> Retry:
+    """Re-sends the task like Task.retry does, but keeping its retries count and backoff for actual failures."""
+
+    request = task.request
+    signature = task.signature_from_request(request, countdown=countdown, retries=request.retries)
+    if not request.is_eager:
+        signature.apply_async()
+    return Retry(when=countdown, is_eager=request.is_eager, sig=signature)
+
+
+def _reserve_output_space(tmp_dir_path: Path, estimated_bytes: int) -> None:
+    """Makes room in the cache for the video about to be produced in the staging directory, before producing it."""
+
+    reserve_cache_space(estimated_bytes)
+    reserve_staging_space(tmp_dir_path, estimated_bytes)
+
+
+def _save_video(video_id: str, video_file_path: Path, source_offset_ms: int = 0) -> VideoFile:
+    video_info = probe(video_file_path)
+    # The estimate reserved for the staged video is counted until it is ingested, only a larger file needs more room
+    reserve_cache_space(max(video_info.size_bytes - staging_reserved_bytes(video_file_path.parent), 0))
+    video = VideoFile.from_media_info(
+        video_info,
+        id=video_id,
+        file=ingest_file(video_file_path),
+        source_offset_ms=source_offset_ms,
+    )
+    video.save()
+    return video
+
+
+def _youtube_url(youtube_video_id: str) -> str:
+    return f"https://www.youtube.com/watch?v={youtube_video_id}"
+
+
+def _youtube_seekable_streams(youtube_video_id: str) -> List[Tuple[str, Dict[str, str]]]:
+    """Returns URLs and HTTP headers of the streams YOUTUBE_VIDEO_FORMAT selects, video first.
 
-    logger.info(f"Deleted {len(files_to_remove)} old videos")
+    Returns an empty list if any of the streams can not be read from an arbitrary position over plain HTTP,
+    e.g. for fragmented DASH formats.
+    """
+
+    with youtube_dl.YoutubeDL(dict(
+            format=settings.YOUTUBE_VIDEO_FORMAT,
+            quiet=True,
+            noprogress=True,
+            logger=logger,
+    )) as ydl:
+        info = ydl.extract_info(_youtube_url(youtube_video_id), download=False)
+    formats = info.get('requested_formats') or [info]
+    if any(fmt.get('protocol') not in ('http', 'https') or not fmt.get('url') for fmt in formats):
+        return []
+    return [(fmt['url'], fmt.get('http_headers') or {}) for fmt in formats]
+
+
+def _find_cached_video(video_id: str) -> Optional[VideoFile]:
+    try:
+        video: VideoFile = VideoFile.objects.get(id=video_id)
+    except VideoFile.DoesNotExist:
+        return None
+    video.save(update_fields=('last_used_at',))
+    return video
 
 
 @shared_task(
+    bind=True,
     acks_late=True,
-    autoretry_for=(DownloadError,),
+    autoretry_for=(DownloadError, FFmpegError),
     retry_backoff=5,
     default_retry_delay=3.0,
     max_retries=5,
     rate_limit=settings.YOUTUBE_RATE_LIMIT,
 )
-def download_video_from_youtube(youtube_video_id: str) -> VideoId:
+def download_video_from_youtube(
+        self: Task,
+        youtube_video_id: str,
+        *,
+        cut_from_ms: Optional[int] = None,
+        cut_to_ms: Optional[int] = None,
+) -> VideoId:
+    """Downloads the video, or only the part of it covering the cut if one is given.
+
+    A cut video is stored with source_offset_ms set to the position of its start in the source video,
+    so that consumers shift their cuts accordingly. A downloaded full video satisfies any cut.
+    """
+
     target_video_id = hashed(youtube_video_id)[:32]
-    try:
-        target_video: VideoFile = VideoFile.objects.get(id=target_video_id)
-    except VideoFile.DoesNotExist:
-        pass
-    else:
-        target_video.save(update_fields=('last_used_at',))
-        logger.debug(f"Download video {youtube_video_id}: found in cache")
-        return VideoId(target_video.id)
+    segment_streams: List[Tuple[str, Dict[str, str]]] = []
+    if settings.YOUTUBE_SEGMENT_DOWNLOAD_ENABLED and (cut_from_ms is not None or cut_to_ms is not None):
+        segment_video_id = hashed(f"{youtube_video_id}/{cut_from_ms}/{cut_to_ms}")[:32]
+        for video_id in (target_video_id, segment_video_id):
+            cached_video = _find_cached_video(video_id)
+            if cached_video is not None:
+                logger.debug(f"Download video {youtube_video_id}: found in cache")
+                return VideoId(cached_video.id)
+
+        segment_streams = _youtube_seekable_streams(youtube_video_id)
+        if segment_streams:
+            target_video_id = segment_video_id
+        else:
+            logger.debug(f"Download video {youtube_video_id}: streams are not seekable, downloading the full video")
 
-    logger.info(f"Download video {youtube_video_id}: started")
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        tmp_dir_path = Path(tmp_dir)
-
-        with youtube_dl.YoutubeDL(dict(
-                format=settings.YOUTUBE_VIDEO_FORMAT,
-                outtmpl=str(tmp_dir_path / f"{target_video_id}.%(ext)s"),
-                ratelimit=None,
-                quiet=True,
-                noprogress=True,
-                logger=logger,
-        )) as ydl:
-            ydl.download([f"https://www.youtube.com/watch?v={youtube_video_id}"])
-        video_file_path = list(tmp_dir_path.glob(f"{target_video_id}.*"))[0]
-
-        logger.debug(f"Download video {youtube_video_id}: saving")
-
-        with VideoFileClip(filename=str(video_file_path)) as clip:
-            video_duration = clip.duration
-            video_width, video_height = clip.size
-
-        with video_file_path.open(mode='rb') as file:
-            target_video = VideoFile(
-                id=target_video_id,
-                duration=video_duration,
-                width=video_width,
-                height=video_height,
-                file=File(file, name=video_file_path.parts[-1]),
-            )
-            target_video.save()
-    logger.info(f"Download video {youtube_video_id}: finished")
-    return VideoId(target_video.id)
+    with _single_flight_or_retry(self, target_video_id):
+        try:
+            target_video: VideoFile = VideoFile.objects.get(id=target_video_id)
+        except VideoFile.DoesNotExist:
+            pass
+        else:
+            target_video.save(update_fields=('last_used_at',))
+            logger.debug(f"Download video {youtube_video_id}: found in cache")
+            return VideoId(target_video.id)
+
+        logger.info(f"Download video {youtube_video_id}: started")
+        with staging_dir(target_video_id, resumable=True) as tmp_dir_path:
+            source_offset_ms = 0
+            if segment_streams:
+                segment_from_ms = max((cut_from_ms or 0) - settings.YOUTUBE_SEGMENT_MARGIN_MS, 0)
+                segment_to_ms = cut_to_ms + settings.YOUTUBE_SEGMENT_MARGIN_MS if cut_to_ms else None
+                logger.info(f"Download video {youtube_video_id}: segment {segment_from_ms}-{segment_to_ms} ms")
+                video_file_path = tmp_dir_path / f"{target_video_id}.mkv"
+                segment_start = download_segment(
+                    segment_streams,
+                    video_file_path,
+                    start=segment_from_ms / 1000,
+                    end=segment_to_ms / 1000 if segment_to_ms else None,
+                )
+                source_offset_ms = round(segment_start * 1000)
+            else:
+                with youtube_dl.YoutubeDL(dict(
+                        format=settings.YOUTUBE_VIDEO_FORMAT,
+                        outtmpl=str(tmp_dir_path / f"{target_video_id}.%(ext)s"),
+                        # Resumes .part files and fragments left by a previous attempt in the staging directory
+                        continuedl=True,
+                        ratelimit=None,
+                        quiet=True,
+                        noprogress=True,
+                        logger=logger,
+                )) as ydl:
+                    ydl.download([_youtube_url(youtube_video_id)])
+                video_file_path = list(tmp_dir_path.glob(f"{target_video_id}.*"))[0]
+
+            logger.debug(f"Download video {youtube_video_id}: saving")
+            target_video = _save_video(target_video_id, video_file_path, source_offset_ms=source_offset_ms)
+        logger.info(f"Download video {youtube_video_id}: finished")
+        return VideoId(target_video.id)
 
 
 @shared_task(
+    bind=True,
     acks_late=True,
-    autoretry_for=(requests.ConnectionError,),
+    autoretry_for=(requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError),
     retry_backoff=5,
     default_retry_delay=3.0,
     max_retries=5,
 )
-def download_video_from_link(url: str, video_id: Optional[str] = None) -> VideoId:
+def download_video_from_link(self: Task, url: str, video_id: Optional[str] = None) -> VideoId:
     target_video_id = hashed(video_id or url)[:32]
-    try:
-        target_video: VideoFile = VideoFile.objects.get(id=target_video_id)
-    except VideoFile.DoesNotExist:
-        pass
-    else:
-        target_video.save(update_fields=('last_used_at',))
-        logger.debug(f"Download video {target_video_id}: found in cache")
+    with _single_flight_or_retry(self, target_video_id):
+        try:
+            target_video: VideoFile = VideoFile.objects.get(id=target_video_id)
+        except VideoFile.DoesNotExist:
+            pass
+        else:
+            target_video.save(update_fields=('last_used_at',))
+            logger.debug(f"Download video {target_video_id}: found in cache")
+            return VideoId(target_video.id)
+
+        logger.info(f"Download video {target_video_id}: started")
+        with staging_dir(target_video_id, resumable=True) as tmp_dir_path:
+            video_file_ext = url.split('?')[0].split('.')[-1]
+            video_file_name = f"{target_video_id}.{video_file_ext}"
+            video_file_path = tmp_dir_path / video_file_name
+
+            download(url, video_file_path)
+
+            logger.debug(f"Download video {target_video_id}: saving")
+            target_video = _save_video(target_video_id, video_file_path)
+        logger.info(f"Download video {target_video_id}: finished")
         return VideoId(target_video.id)
 
-    logger.info(f"Download video {target_video_id}: started")
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        tmp_dir_path = Path(tmp_dir)
-        video_file_ext = url.split('?')[0].split('.')[-1]
-        video_file_name = f"{target_video_id}.{video_file_ext}"
-        video_file_path = tmp_dir_path / video_file_name
-
-        resp = requests.get(url, stream=True, timeout=(3.05, 27))
-        resp.raise_for_status()
-        with open(video_file_path, mode='wb') as file:
-            for chunk in resp.iter_content():
-                file.write(chunk)
-
-        logger.debug(f"Download video {target_video_id}: saving")
-
-        with VideoFileClip(filename=str(video_file_path)) as clip:
-            video_duration = clip.duration
-            video_width, video_height = clip.size
-
-        with video_file_path.open(mode='rb') as file:
-            target_video = VideoFile(
-                id=target_video_id,
-                duration=video_duration,
-                width=video_width,
-                height=video_height,
-                file=File(file, name=video_file_path.parts[-1]),
-            )
-            target_video.save()
-    logger.info(f"Download video {target_video_id}: finished")
-    return VideoId(target_video.id)
+
+def _cut_size_bytes(video: VideoFile, info: MediaInfo, cut_from_ms: int, cut_to_ms: Optional[int]) -> int:
+    """Estimates the size of a cut of the video as the share of the source it keeps."""
+
+    if info.duration <= 0:
+        return video.size_bytes
+    cut_end = min(cut_to_ms / 1000, info.duration) if cut_to_ms else info.duration
+    return int(video.size_bytes * max(cut_end - cut_from_ms / 1000, 0) / info.duration)
 
 
-@shared_task(acks_late=True)
+@shared_task(acks_late=True, bind=True)
 def transform_video(
+        self: Task,
         src_video_id: VideoId,
         *,
         cut_from_ms: Optional[int] = None,
@@ -159,52 +271,68 @@ def transform_video(
     src_video.save(update_fields=('last_used_at',))
 
     target_video_id = hashed(f"{src_video_id}/{cut_from_ms}/{cut_to_ms}")[:32]
-    try:
-        target_video: VideoFile = VideoFile.objects.get(id=target_video_id)
-    except VideoFile.DoesNotExist:
-        pass
-    else:
-        target_video.save(update_fields=('last_used_at',))
-        logger.debug(f"Transform video {src_video.id}: found in cache")
-        return VideoId(target_video.id)
-
-    if cut_from_ms is None and cut_to_ms is None:
-        return src_video_id
+    with _single_flight_or_retry(self, target_video_id):
+        try:
+            target_video: VideoFile = VideoFile.objects.get(id=target_video_id)
+        except VideoFile.DoesNotExist:
+            pass
+        else:
+            target_video.save(update_fields=('last_used_at',))
+            logger.debug(f"Transform video {src_video.id}: found in cache")
+            return VideoId(target_video.id)
 
-    if cut_from_ms is None:
-        cut_from_ms = 0
+        if cut_from_ms is None and cut_to_ms is None:
+            return src_video_id
 
-    logger.info(f"Transform video {src_video.id}: started")
-    with VideoFileClip(filename=src_video.file.path) as clip:
+        # Cuts are positions in the source video, while segment downloads start at source_offset_ms of it
+        cut_from_ms = max((cut_from_ms or 0) - src_video.source_offset_ms, 0)
         if cut_to_ms:
-            clip = clip.subclip(cut_from_ms / 1000, cut_to_ms / 1000)
-        else:
-            clip = clip.subclip(cut_from_ms / 1000)
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            tmp_dir_path = Path(tmp_dir)
+            cut_to_ms -= src_video.source_offset_ms
+
+        logger.info(f"Transform video {src_video.id}: started")
+        info = src_video.media_info()
+        with staging_dir(target_video_id) as tmp_dir_path:
             video_file_path = tmp_dir_path / f"{target_video_id}.{settings.VIDEO_TEMP_OUTPUT_FORMAT}"
-            clip.write_videofile(
-                filename=str(video_file_path),
-                logger=None,
-                threads=1,
-                **settings.VIDEO_TEMP_ENCODER_SETTINGS,
-            )
+            _reserve_output_space(tmp_dir_path, _cut_size_bytes(src_video, info, cut_from_ms, cut_to_ms))
+            with encoder_threads() as threads:
+                logger.info(f"Transform video {src_video.id}: encoding with {threads} threads")
+                smart_cut_done = False
+                if settings.VIDEO_SMART_CUT_ENABLED:
+                    try:
+                        smart_cut(
+                            src=Path(src_video.file.path),
+                            dst=video_file_path,
+                            start=cut_from_ms / 1000,
+                            end=cut_to_ms / 1000 if cut_to_ms else None,
+                            info=info,
+                            threads=threads,
+                        )
+                        smart_cut_done = True
+                    except SmartCutUnsupported as exc:
+                        logger.debug(f"Transform video {src_video.id}: smart cut is not possible ({exc})")
+                    except FFmpegError as exc:
+                        logger.warning(f"Transform video {src_video.id}: smart cut failed, using MoviePy ({exc})")
+                if not smart_cut_done:
+                    with VideoFileClip(filename=src_video.file.path) as clip:
+                        if cut_to_ms:
+                            clip = clip.subclip(cut_from_ms / 1000, cut_to_ms / 1000)
+                        else:
+                            clip = clip.subclip(cut_from_ms / 1000)
+                        clip.write_videofile(
+                            filename=str(video_file_path),
+                            logger=None,
+                            threads=threads,
+                            **settings.VIDEO_TEMP_ENCODER_SETTINGS,
+                        )
+
             logger.debug(f"Transform video {src_video.id}: saving")
-            with video_file_path.open(mode='rb') as file:
-                target_video = VideoFile(
-                    id=target_video_id,
-                    duration=clip.duration,
-                    width=clip.size[0],
-                    height=clip.size[1],
-                    file=File(file, name=video_file_path.parts[-1]),
-                )
-                target_video.save()
-    logger.info(f"Transform video {src_video.id}: finished")
-    return VideoId(target_video.id)
+            target_video = _save_video(target_video_id, video_file_path)
+        logger.info(f"Transform video {src_video.id}: finished")
+        return VideoId(target_video.id)
 
 
-@shared_task(acks_late=True)
-def concatenate_videos(src_video_ids: List[VideoId]) -> VideoId:
+@shared_task(acks_late=True, bind=True)
+def concatenate_videos(self: Task, src_video_ids: List[VideoId]) -> VideoId:
     src_videos: List[VideoFile] = []
     for src_video_id in src_video_ids:
         src_video: VideoFile = VideoFile.objects.get(id=src_video_id)
@@ -217,44 +345,47 @@ def concatenate_videos(src_video_ids: List[VideoId]) -> VideoId:
     src_videos_verb = '[' + ', '.join(src_video_ids) + ']'
 
     target_video_id = hashed('/'.join(src_video_ids))[:32]
-    try:
-        target_video: VideoFile = VideoFile.objects.get(id=target_video_id)
-    except VideoFile.DoesNotExist:
-        pass
-    else:
-        target_video.save(update_fields=('last_used_at',))
-        logger.debug(f"Concatenate videos {src_videos_verb} ({len(src_videos)}): found in cache")
-        return VideoId(target_video.id)
+    with _single_flight_or_retry(self, target_video_id):
+        try:
+            target_video: VideoFile = VideoFile.objects.get(id=target_video_id)
+        except VideoFile.DoesNotExist:
+            pass
+        else:
+            target_video.save(update_fields=('last_used_at',))
+            logger.debug(f"Concatenate videos {src_videos_verb} ({len(src_videos)}): found in cache")
+            return VideoId(target_video.id)
 
-    logger.info(f"Concatenate videos {src_videos_verb} ({len(src_videos)}): started")
-    clips = [VideoFileClip(filename=video.file.path) for video in src_videos]
-    try:
-        with concatenate_videoclips(clips) as clip:
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                tmp_dir_path = Path(tmp_dir)
-                video_file_path = tmp_dir_path / f"{target_video_id}.{settings.VIDEO_TEMP_OUTPUT_FORMAT}"
-                clip.write_videofile(
-                    filename=str(video_file_path),
-                    logger=None,
-                    threads=1,
-                    **settings.VIDEO_TEMP_ENCODER_SETTINGS,
-                )
-                logger.debug(f"Concatenate videos {src_videos_verb} ({len(src_videos)}): saving")
-                with video_file_path.open(mode='rb') as file:
-                    target_video = VideoFile(
-                        id=target_video_id,
-                        duration=clip.duration,
-                        width=clip.size[0],
-                        height=clip.size[1],
-                        file=File(file, name=video_file_path.parts[-1]),
+        logger.info(f"Concatenate videos {src_videos_verb} ({len(src_videos)}): started")
+        with staging_dir(target_video_id) as tmp_dir_path:
+            video_file_path = tmp_dir_path / f"{target_video_id}.{settings.VIDEO_TEMP_OUTPUT_FORMAT}"
+            _reserve_output_space(tmp_dir_path, sum(video.size_bytes for video in src_videos))
+            src_video_paths = [Path(video.file.path) for video in src_videos]
+            if settings.VIDEO_CONCAT_COPY_ENABLED and can_concat_copy([video.media_info() for video in src_videos]):
+                logger.debug(f"Concatenate videos {src_videos_verb} ({len(src_videos)}): stream copy")
+                concat_copy(src_video_paths, video_file_path, extra_args=['-movflags', '+faststart'])
+            else:
+                with encoder_threads() as threads:
+                    logger.info(
+                        f"Concatenate videos {src_videos_verb} ({len(src_videos)}): encoding with {threads} threads"
                     )
-                    target_video.save()
-    finally:
-        logger.debug(f"Concatenate videos {src_videos_verb} ({len(src_videos)}): cleanup")
-        for clip in clips:
-            clip.close()
-    logger.info(f"Concatenate videos {src_videos_verb} ({len(src_videos)}): finished")
-    return VideoId(target_video.id)
+                    clips = [VideoFileClip(filename=str(path)) for path in src_video_paths]
+                    try:
+                        with concatenate_videoclips(clips) as clip:
+                            clip.write_videofile(
+                                filename=str(video_file_path),
+                                logger=None,
+                                threads=threads,
+                                **settings.VIDEO_TEMP_ENCODER_SETTINGS,
+                            )
+                    finally:
+                        logger.debug(f"Concatenate videos {src_videos_verb} ({len(src_videos)}): cleanup")
+                        for clip in clips:
+                            clip.close()
+
+            logger.debug(f"Concatenate videos {src_videos_verb} ({len(src_videos)}): saving")
+            target_video = _save_video(target_video_id, video_file_path)
+        logger.info(f"Concatenate videos {src_videos_verb} ({len(src_videos)}): finished")
+        return VideoId(target_video.id)
 
 
 class VideoFormats(Enum):
@@ -262,13 +393,161 @@ class VideoFormats(Enum):
     WEBM = 'webm'
 
 
-@shared_task(acks_late=True)
+# Audio encoders for each output format. MoviePy is given them as well, as it picks libmp3lame for mp4
+VIDEO_FORMAT_AUDIO_CODECS = {
+    VideoFormats.MP4: 'aac',
+    VideoFormats.WEBM: 'libvorbis',
+}
+# FFmpeg encoder arguments for each output format: video encoders match what MoviePy picks in encode_video
+VIDEO_FORMAT_VIDEO_ENCODER_ARGS = {
+    VideoFormats.MP4: ['-c:v', 'libx264', '-preset', 'slow', '-pix_fmt', 'yuv420p'],
+    VideoFormats.WEBM: ['-c:v', 'libvpx'],
+}
+VIDEO_FORMAT_AUDIO_ENCODER_ARGS = {
+    output_format: ['-c:a', audio_codec]
+    for output_format, audio_codec in VIDEO_FORMAT_AUDIO_CODECS.items()
+}
+VIDEO_FORMAT_MUXER_ARGS = {
+    VideoFormats.MP4: ['-movflags', '+faststart'],
+    VideoFormats.WEBM: [],
+}
+VIDEO_FORMAT_ENCODER_ARGS = {
+    output_format: [
+        *VIDEO_FORMAT_VIDEO_ENCODER_ARGS[output_format],
+        *VIDEO_FORMAT_AUDIO_ENCODER_ARGS[output_format],
+        *VIDEO_FORMAT_MUXER_ARGS[output_format],
+    ]
+    for output_format in VideoFormats
+}
+
+
+# Codecs that encode_video produces for each output format: video codecs, audio codecs
+VIDEO_FORMAT_CODECS = {
+    VideoFormats.MP4: ({'h264'}, {'aac'}),
+    VideoFormats.WEBM: ({'vp8', 'vp9'}, {'vorbis', 'opus'}),
+}
+# Bitrate of the audio encode_video produces, FFmpeg's default
+ENCODE_AUDIO_BITRATE_KBPS = 128
+
+
+def _encoded_size_bytes(duration: float, bitrate_kbps: int) -> int:
+    """Estimates the size of a video of the duration encoded with the video bitrate and the default audio."""
+
+    return int(duration * (bitrate_kbps + ENCODE_AUDIO_BITRATE_KBPS) * 1000 / 8)
+
+
+# Encoder arguments for sample encodes of target-size encoding: the quality above which bitrate is wasted
+VIDEO_FORMAT_SAMPLE_ENCODER_ARGS = {
+    VideoFormats.MP4: ['-c:v', 'libx264', '-preset', 'slow', '-crf', '23'],
+    VideoFormats.WEBM: ['-c:v', 'libvpx', '-crf', '10', '-b:v', '10M'],
+}
+
+
+def _target_size_budget_kbps(duration: float, target_size_bytes: int, *, fallback_kbps: int) -> int:
+    """Returns the video bitrate filling target_size_bytes with a video of the duration and its audio.
+
+    Returns fallback_kbps if the duration is unknown, as some streamed and live-recorded files report zero.
+    """
+
+    if duration <= 0:
+        logger.warning(f"Duration is {duration}, encoding at {fallback_kbps} kbps instead of a target size")
+        return fallback_kbps
+    total_kbps = target_size_bytes * 8 * (1 - settings.VIDEO_TARGET_SIZE_HEADROOM) / duration / 1000
+    return max(int(total_kbps) - ENCODE_AUDIO_BITRATE_KBPS, settings.VIDEO_TARGET_SIZE_MIN_KBPS)
+
+
+def _sample_windows(inputs: Sequence[RenderInput]) -> List[RenderInput]:
+    """Picks parts evenly spread over the timeline of the concatenated inputs, which must have ends."""
+
+    count = settings.VIDEO_TARGET_SIZE_SAMPLES
+    length = settings.VIDEO_TARGET_SIZE_SAMPLE_SECONDS
+    durations = [item.end - item.start for item in inputs if item.end is not None]
+    if sum(durations) <= count * length:
+        return list(inputs)
+
+    samples: List[RenderInput] = []
+    for n in range(count):
+        # Centers of equal parts of the timeline
+        position = sum(durations) * (2 * n + 1) / (2 * count)
+        for item, duration in zip(inputs, durations):
+            if position < duration:
+                offset = min(max(position - length / 2, 0), max(duration - length, 0))
+                samples.append(RenderInput(
+                    path=item.path,
+                    start=item.start + offset,
+                    end=item.start + min(offset + length, duration),
+                ))
+                break
+            position -= duration
+    return samples
+
+
+def _target_size_bitrate_kbps(
+        inputs: Sequence[RenderInput],
+        output_format: VideoFormats,
+        target_size_bytes: int,
+        threads: int,
+        *,
+        fallback_kbps: int,
+) -> int:
+    """Picks the video bitrate for a file of about target_size_bytes made of the inputs, which must have ends.
+
+    The bitrate is lowered to the one sample encodes need at the sample quality,
+    so that short videos do not take the whole size for quality that cannot be seen.
+    """
+
+    duration = sum(item.end - item.start for item in inputs if item.end is not None)
+    budget_kbps = _target_size_budget_kbps(duration, target_size_bytes, fallback_kbps=fallback_kbps)
+    if duration <= 0:
+        return budget_kbps
+    sampled_bps = sample_bitrate(
+        _sample_windows(inputs),
+        encoder_args=VIDEO_FORMAT_SAMPLE_ENCODER_ARGS[output_format],
+        threads=threads,
+    )
+    return max(min(budget_kbps, int(sampled_bps / 1000)), settings.VIDEO_TARGET_SIZE_MIN_KBPS)
+
+
+def _check_target_size(video: VideoFile, target_size_bytes: Optional[int]) -> None:
+    if target_size_bytes and video.size_bytes > target_size_bytes:
+        logger.warning(f"Video {video.id}: {video.size_bytes} bytes, target size was {target_size_bytes} bytes")
+
+
+class EncodeDecision(Enum):
+    PASSTHROUGH = 'passthrough'
+    REMUX = 'remux'
+    ENCODE = 'encode'
+
+
+def _encode_decision(info: MediaInfo, path: Path, output_format: VideoFormats, bitrate_kbps: int) -> EncodeDecision:
+    """Tells whether encoding the video would make it smaller or more compatible than it is."""
+
+    if not settings.VIDEO_PASSTHROUGH_ENABLED:
+        return EncodeDecision.ENCODE
+    video_codecs, audio_codecs = VIDEO_FORMAT_CODECS[output_format]
+    if info.video_codec not in video_codecs or info.pix_fmt != 'yuv420p':
+        return EncodeDecision.ENCODE
+    if info.audio_codec is not None and info.audio_codec not in audio_codecs:
+        return EncodeDecision.ENCODE
+    if info.bitrate is None or info.bitrate > (bitrate_kbps + ENCODE_AUDIO_BITRATE_KBPS) * 1000:
+        return EncodeDecision.ENCODE
+    # Remuxing also moves the MP4 index to the front, so players can start before the whole file is downloaded
+    if path.suffix != f".{output_format.value}" or output_format is VideoFormats.MP4 and not is_faststart(path):
+        return EncodeDecision.REMUX
+    return EncodeDecision.PASSTHROUGH
+
+
+@shared_task(acks_late=True, bind=True)
 def encode_video(
+        self: Task,
         src_video_id: VideoId,
         *,
         output_format: Optional[VideoFormats] = VideoFormats.MP4,
         bitrate_kbps: Optional[int] = 700,
+        target_size_bytes: Optional[int] = None,
 ) -> VideoId:
+    """Encodes the video with the bitrate, or with the bitrate making a file of about target_size_bytes if set."""
+
     src_video: VideoFile = VideoFile.objects.get(id=src_video_id)
     src_video.save(update_fields=('last_used_at',))
 
@@ -278,37 +557,367 @@ def encode_video(
     if bitrate_kbps is None:
         bitrate_kbps = 700
 
-    target_video_id = hashed(f"{src_video_id}/{output_format}/{bitrate_kbps}")[:32]
-    try:
-        target_video: VideoFile = VideoFile.objects.get(id=target_video_id)
-    except VideoFile.DoesNotExist:
-        pass
+    info = src_video.media_info()
+    if target_size_bytes:
+        # The budget is enough to tell whether to encode, the sampled bitrate is found when encoding
+        max_bitrate_kbps = _target_size_budget_kbps(info.duration, target_size_bytes, fallback_kbps=bitrate_kbps)
+        target_video_id = hashed(f"{src_video_id}/{output_format}/size={target_size_bytes}")[:32]
     else:
-        target_video.save(update_fields=('last_used_at',))
-        logger.debug(f"Encode video {src_video.id}: found in cache")
-        return VideoId(target_video.id)
+        max_bitrate_kbps = bitrate_kbps
+        target_video_id = hashed(f"{src_video_id}/{output_format}/{bitrate_kbps}")[:32]
 
-    logger.info(f"Encode video {src_video.id}: started")
-    with VideoFileClip(filename=src_video.file.path) as clip:
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            tmp_dir_path = Path(tmp_dir)
-            video_file_path = tmp_dir_path / f"{target_video_id}.{output_format.value}"
-            clip.write_videofile(
-                filename=str(video_file_path),
-                logger=None,
-                threads=1,
-                preset='slow',
-                bitrate=f"{bitrate_kbps}K"
+    decision = _encode_decision(info, Path(src_video.file.path), output_format, max_bitrate_kbps)
+    sentry_sdk.set_tag('encode_decision', decision.value)
+    logger.info(f"Encode video {src_video.id}: {decision.value}")
+    if decision is EncodeDecision.PASSTHROUGH:
+        return src_video_id
+
+    with _single_flight_or_retry(self, target_video_id):
+        try:
+            target_video: VideoFile = VideoFile.objects.get(id=target_video_id)
+        except VideoFile.DoesNotExist:
+            pass
+        else:
+            target_video.save(update_fields=('last_used_at',))
+            logger.debug(f"Encode video {src_video.id}: found in cache")
+            return VideoId(target_video.id)
+
+        if decision is EncodeDecision.REMUX:
+            with staging_dir(target_video_id) as tmp_dir_path:
+                video_file_path = tmp_dir_path / f"{target_video_id}.{output_format.value}"
+                _reserve_output_space(tmp_dir_path, src_video.size_bytes)
+                remux(Path(src_video.file.path), video_file_path, extra_args=VIDEO_FORMAT_MUXER_ARGS[output_format])
+                logger.debug(f"Encode video {src_video.id}: saving")
+                target_video = _save_video(target_video_id, video_file_path)
+            logger.info(f"Encode video {src_video.id}: finished")
+            return VideoId(target_video.id)
+
+        logger.info(f"Encode video {src_video.id}: started")
+        checkpoint_path = checkpoint_dir(src_video_id, target_video_id)
+        segmented_encode = read_manifest(checkpoint_path)
+        if segmented_encode is not None:
+            logger.info(f"Encode video {src_video.id}: resuming from checkpoints")
+        else:
+            if target_size_bytes:
+                with encoder_threads() as threads:
+                    bitrate_kbps = _target_size_bitrate_kbps(
+                        [RenderInput(path=Path(src_video.file.path), end=info.duration)],
+                        output_format,
+                        target_size_bytes,
+                        threads,
+                        fallback_kbps=bitrate_kbps,
+                    )
+            segmented_encode = _split_for_segmented_encode(src_video, info, checkpoint_path, bitrate_kbps)
+
+        if segmented_encode is None:
+            with VideoFileClip(filename=src_video.file.path) as clip:
+                with staging_dir(target_video_id) as tmp_dir_path:
+                    video_file_path = tmp_dir_path / f"{target_video_id}.{output_format.value}"
+                    _reserve_output_space(tmp_dir_path, _encoded_size_bytes(info.duration, bitrate_kbps))
+                    with encoder_threads() as threads:
+                        logger.info(
+                            f"Encode video {src_video.id}: encoding at {bitrate_kbps} kbps with {threads} threads"
+                        )
+                        clip.write_videofile(
+                            filename=str(video_file_path),
+                            logger=None,
+                            threads=threads,
+                            preset='slow',
+                            bitrate=f"{bitrate_kbps}K",
+                            audio_codec=VIDEO_FORMAT_AUDIO_CODECS[output_format],
+                        )
+                    logger.debug(f"Encode video {src_video.id}: saving")
+                    target_video = _save_video(target_video_id, video_file_path)
+            _check_target_size(target_video, target_size_bytes)
+            logger.info(f"Encode video {src_video.id}: finished")
+            return VideoId(target_video.id)
+
+        segment_names = segmented_encode.segment_names
+        if not settings.VIDEO_SEGMENTED_ENCODE_DISTRIBUTED:
+            with encoder_threads() as threads:
+                for segment_n, segment_name in enumerate(segment_names, start=1):
+                    logger.info(
+                        f"Encode video {src_video.id}: segment {segment_n}/{len(segment_names)}"
+                        f" at {segmented_encode.bitrate_kbps} kbps with {threads} threads"
+                    )
+                    _encode_segment(checkpoint_path / segment_name, output_format, segmented_encode, threads)
+            target_video = _join_segments(src_video, target_video_id, checkpoint_path, segment_names, output_format)
+            _check_target_size(target_video, target_size_bytes)
+            logger.info(f"Encode video {src_video.id}: finished")
+            return VideoId(target_video.id)
+
+    # Replaced outside of the lock, which the join task takes
+    logger.info(
+        f"Encode video {src_video.id}: encoding {len(segment_names)} segments"
+        f" at {segmented_encode.bitrate_kbps} kbps"
+    )
+    return self.replace(chord(
+        header=[
+            encode_video_segment.si(src_video_id, target_video_id, segment_name, output_format=output_format)
+            for segment_name in segment_names
+        ],
+        body=join_video_segments.s(
+            src_video_id=src_video_id,
+            target_video_id=target_video_id,
+            output_format=output_format,
+            target_size_bytes=target_size_bytes,
+        ),
+    ))
+
+
+def _split_for_segmented_encode(
+        src_video: VideoFile,
+        info: MediaInfo,
+        checkpoint_path: Path,
+        bitrate_kbps: int,
+) -> Optional[SegmentedEncode]:
+    """Splits the video stream into segments for encoding one by one, and checkpoints the split.
+
+    Returns None if the video is to be encoded in one piece, i.e. if it is too short to be worth splitting.
+    """
+
+    if not settings.VIDEO_SEGMENTED_ENCODE_ENABLED or info.duration < settings.VIDEO_SEGMENTED_ENCODE_MIN_DURATION:
+        return None
+    # Leftovers of a split interrupted before its manifest was written
+    shutil.rmtree(checkpoint_path, ignore_errors=True)
+    checkpoint_path.mkdir(parents=True)
+    segment_paths = split_video(Path(src_video.file.path), checkpoint_path, settings.VIDEO_SEGMENT_SECONDS)
+    if len(segment_paths) < 2:
+        shutil.rmtree(checkpoint_path, ignore_errors=True)
+        return None
+    for segment_path in segment_paths:
+        fsync_file(segment_path)
+    segmented_encode = SegmentedEncode(
+        segment_names=[segment_path.name for segment_path in segment_paths],
+        bitrate_kbps=bitrate_kbps,
+    )
+    write_manifest(checkpoint_path, segmented_encode)
+    return segmented_encode
+
+
+def _encode_segment(
+        src_path: Path,
+        output_format: VideoFormats,
+        segmented_encode: SegmentedEncode,
+        threads: int,
+) -> str:
+    """Encodes the video stream of a segment, unless it is already checkpointed. Returns the name of the result."""
+
+    dst_path = src_path.with_name(f"{src_path.stem.replace('src', 'enc', 1)}.mkv")
+    if dst_path.exists():
+        logger.debug(f"Encode segment {src_path}: found in checkpoint")
+        return dst_path.name
+    # Dot-files are not taken for checkpoints if the worker crashes while writing them
+    tmp_dst_path = dst_path.with_name(f".{dst_path.name}")
+    encode_video_stream(
+        src_path,
+        tmp_dst_path,
+        encoder_args=[*VIDEO_FORMAT_VIDEO_ENCODER_ARGS[output_format], '-b:v', f"{segmented_encode.bitrate_kbps}K"],
+        threads=threads,
+    )
+    fsync_file(tmp_dst_path)
+    os.replace(tmp_dst_path, dst_path)
+    return dst_path.name
+
+
+def _join_segments(
+        src_video: VideoFile,
+        target_video_id: str,
+        checkpoint_path: Path,
+        segment_names: List[str],
+        output_format: VideoFormats,
+) -> VideoFile:
+    """Joins the encoded segments without re-encoding, adding the audio encoded in one piece."""
+
+    logger.info(f"Join segments {target_video_id} ({len(segment_names)}): started")
+    encoded_segment_paths = [checkpoint_path / segment_name.replace('src', 'enc', 1) for segment_name in segment_names]
+    with staging_dir(target_video_id) as tmp_dir_path:
+        video_file_path = tmp_dir_path / f"{target_video_id}.{output_format.value}"
+        _reserve_output_space(
+            tmp_dir_path,
+            sum(path.stat().st_size for path in encoded_segment_paths) + _encoded_size_bytes(src_video.duration, 0),
+        )
+        join_video_parts(
+            encoded_segment_paths,
+            Path(src_video.file.path),
+            video_file_path,
+            audio_args=VIDEO_FORMAT_AUDIO_ENCODER_ARGS[output_format],
+            extra_args=VIDEO_FORMAT_MUXER_ARGS[output_format],
+        )
+        logger.debug(f"Join segments {target_video_id} ({len(segment_names)}): saving")
+        target_video = _save_video(target_video_id, video_file_path)
+    shutil.rmtree(checkpoint_path, ignore_errors=True)
+    logger.info(f"Join segments {target_video_id} ({len(segment_names)}): finished")
+    return target_video
+
+
+@shared_task(acks_late=True, bind=True)
+def encode_video_segment(
+        self: Task,
+        src_video_id: VideoId,
+        target_video_id: str,
+        segment_name: str,
+        *,
+        output_format: VideoFormats,
+) -> str:
+    """Encodes a segment of a distributed encode_video, returns the name of the result."""
+
+    checkpoint_path = checkpoint_dir(src_video_id, target_video_id)
+    segmented_encode = read_manifest(checkpoint_path)
+    if segmented_encode is None:
+        raise FileNotFoundError(f"Checkpoint of video {target_video_id} is missing")
+    with _single_flight_or_retry(self, f"{target_video_id}/{segment_name}"):
+        with encoder_threads() as threads:
+            logger.info(f"Encode segment {target_video_id}/{segment_name}: encoding with {threads} threads")
+            return _encode_segment(checkpoint_path / segment_name, output_format, segmented_encode, threads)
+
+
+@shared_task(acks_late=True, bind=True)
+def join_video_segments(  # pylint: disable=too-many-arguments
+        self: Task,
+        encoded_segment_names: List[str],
+        *,
+        src_video_id: VideoId,
+        target_video_id: str,
+        output_format: VideoFormats,
+        target_size_bytes: Optional[int] = None,
+) -> VideoId:
+    """Joins the segments of a distributed encode_video once all of them are encoded."""
+
+    with _single_flight_or_retry(self, target_video_id):
+        target_video = _find_cached_video(target_video_id)
+        if target_video is not None:
+            logger.debug(f"Join segments {target_video_id}: found in cache")
+            return VideoId(target_video.id)
+
+        checkpoint_path = checkpoint_dir(src_video_id, target_video_id)
+        segmented_encode = read_manifest(checkpoint_path)
+        if segmented_encode is None or len(encoded_segment_names) != len(segmented_encode.segment_names):
+            raise FileNotFoundError(f"Checkpoint of video {target_video_id} is missing")
+        src_video: VideoFile = VideoFile.objects.get(id=src_video_id)
+        target_video = _join_segments(
+            src_video,
+            target_video_id,
+            checkpoint_path,
+            segmented_encode.segment_names,
+            output_format,
+        )
+    _check_target_size(target_video, target_size_bytes)
+    return VideoId(target_video.id)
+
+
+@shared_task(acks_late=True, bind=True)
+def render_video(  # pylint: disable=too-many-arguments
+        self: Task,
+        src_video_ids: List[VideoId],
+        *,
+        cuts: List[Tuple[Optional[int], Optional[int]]],
+        output_format: Optional[VideoFormats] = VideoFormats.MP4,
+        bitrate_kbps: Optional[int] = 700,
+        target_size_bytes: Optional[int] = None,
+) -> VideoId:
+    """Does the work of transform_video, concatenate_videos and encode_video in a single encoding pass."""
+
+    if len(cuts) != len(src_video_ids):
+        raise ValueError(f"Expected {len(src_video_ids)} cuts, got {len(cuts)}")
+
+    src_videos: List[VideoFile] = []
+    for src_video_id in src_video_ids:
+        src_video: VideoFile = VideoFile.objects.get(id=src_video_id)
+        src_video.save(update_fields=('last_used_at',))
+        src_videos.append(src_video)
+
+    if output_format is None:
+        output_format = VideoFormats.MP4
+
+    if bitrate_kbps is None:
+        bitrate_kbps = 700
+
+    # Same ids as the staged transform -> concatenate -> encode pipeline would produce,
+    # so that results of both pipelines are interchangeable
+    transformed_video_ids: List[VideoId] = []
+    for src_video_id, (cut_from_ms, cut_to_ms) in zip(src_video_ids, cuts):
+        if cut_from_ms is None and cut_to_ms is None:
+            transformed_video_ids.append(src_video_id)
+        else:
+            transformed_video_ids.append(VideoId(hashed(f"{src_video_id}/{cut_from_ms}/{cut_to_ms}")[:32]))
+    if len(transformed_video_ids) == 1:
+        concatenated_video_id = transformed_video_ids[0]
+    else:
+        concatenated_video_id = VideoId(hashed('/'.join(transformed_video_ids))[:32])
+    if target_size_bytes:
+        target_video_id = hashed(f"{concatenated_video_id}/{output_format}/size={target_size_bytes}")[:32]
+    else:
+        target_video_id = hashed(f"{concatenated_video_id}/{output_format}/{bitrate_kbps}")[:32]
+
+    src_videos_verb = '[' + ', '.join(src_video_ids) + ']'
+    with _single_flight_or_retry(self, target_video_id):
+        try:
+            target_video: VideoFile = VideoFile.objects.get(id=target_video_id)
+        except VideoFile.DoesNotExist:
+            pass
+        else:
+            target_video.save(update_fields=('last_used_at',))
+            logger.debug(f"Render video {src_videos_verb} ({len(src_videos)}): found in cache")
+            return VideoId(target_video.id)
+
+        render_inputs: List[RenderInput] = []
+        for src_video, transformed_video_id, (cut_from_ms, cut_to_ms) in zip(src_videos, transformed_video_ids, cuts):
+            # Intermediate results of the staged pipeline are optional, but are used when they already exist
+            try:
+                transformed_video: VideoFile = VideoFile.objects.get(id=transformed_video_id)
+            except VideoFile.DoesNotExist:
+                # Cuts are positions in the source video, while segment downloads start at source_offset_ms of it
+                render_inputs.append(RenderInput(
+                    path=Path(src_video.file.path),
+                    start=max((cut_from_ms or 0) - src_video.source_offset_ms, 0) / 1000,
+                    end=(cut_to_ms - src_video.source_offset_ms) / 1000 if cut_to_ms else None,
+                    info=src_video.media_info(),
+                ))
+            else:
+                transformed_video.save(update_fields=('last_used_at',))
+                render_inputs.append(RenderInput(
+                    path=Path(transformed_video.file.path),
+                    info=transformed_video.media_info(),
+                ))
+
+        # Inputs with their ends within the videos, for estimating the bitrate and the size of the result
+        bounded_inputs = [
+            RenderInput(
+                path=item.path,
+                start=item.start,
+                end=min(item.end, item.info.duration) if item.end is not None else item.info.duration,
             )
-            logger.debug(f"Encode video {src_video.id}: saving")
-            with video_file_path.open(mode='rb') as file:
-                target_video = VideoFile(
-                    id=target_video_id,
-                    duration=clip.duration,
-                    width=clip.size[0],
-                    height=clip.size[1],
-                    file=File(file, name=video_file_path.parts[-1]),
+            for item in render_inputs if item.info is not None
+        ]
+        render_duration = sum(item.end - item.start for item in bounded_inputs if item.end is not None)
+
+        logger.info(f"Render video {src_videos_verb} ({len(src_videos)}): started")
+        with staging_dir(target_video_id) as tmp_dir_path:
+            video_file_path = tmp_dir_path / f"{target_video_id}.{output_format.value}"
+            with encoder_threads() as threads:
+                if target_size_bytes:
+                    bitrate_kbps = _target_size_bitrate_kbps(
+                        bounded_inputs,
+                        output_format,
+                        target_size_bytes,
+                        threads,
+                        fallback_kbps=bitrate_kbps,
+                    )
+                _reserve_output_space(tmp_dir_path, _encoded_size_bytes(render_duration, bitrate_kbps))
+                logger.info(
+                    f"Render video {src_videos_verb} ({len(src_videos)}): "
+                    f"encoding at {bitrate_kbps} kbps with {threads} threads"
                 )
-                target_video.save()
-    logger.info(f"Encode video {src_video.id}: finished")
-    return VideoId(target_video.id)
+                render(
+                    render_inputs,
+                    video_file_path,
+                    encoder_args=[*VIDEO_FORMAT_ENCODER_ARGS[output_format], '-b:v', f"{bitrate_kbps}K"],
+                    threads=threads,
+                )
+
+            logger.debug(f"Render video {src_videos_verb} ({len(src_videos)}): saving")
+            target_video = _save_video(target_video_id, video_file_path)
+        _check_target_size(target_video, target_size_bytes)
+        logger.info(f"Render video {src_videos_verb} ({len(src_videos)}): finished")
+        return VideoId(target_video.id)